@@ -1,2 +1,3 @@
 from . import user
 from . import admin
+from . import channels
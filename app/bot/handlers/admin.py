@@ -3,16 +3,25 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from app.db import async_session
 from app.db.models import Plan, Video, User, Subscription, Payment
 from app.config import settings
-from sqlalchemy import select, func
+from app.services.catalog import video_catalog, plan_catalog
+from app.services.users import browse_users, USER_FILTERS
+from app.services.broadcast import create_job, start_job, cancel_job
+from app.services.stats import get_stats
+from app.services.tracing import profiler
+from datetime import datetime
+from functools import cache
+from html import escape
+from sqlalchemy import select, func, update
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging
 
 router = Router()
 
 class AdminStates(StatesGroup):
     waiting_for_broadcast = State()
+    waiting_for_user_search = State()
 
 class AddPlanStates(StatesGroup):
     waiting_for_name = State()
@@ -26,9 +35,11 @@ class AddVideoStates(StatesGroup):
 def is_admin(user_id: int) -> bool:
     return user_id in settings.ADMIN_IDS
 
+@cache
 def get_cancel_kb():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Bekor qilish", callback_data="admin_cancel_state")]])
 
+@cache
 def get_admin_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Batafsil Statistika", callback_data="admin_stats_advanced")],
@@ -38,6 +49,7 @@ def get_admin_keyboard():
         [InlineKeyboardButton(text="⚙️ Tariflar & Videolar", callback_data="admin_settings_menu")],
     ])
 
+@cache
 def get_settings_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Yangi Tarif Qo'shish", callback_data="admin_add_plan_start")],
@@ -91,7 +103,7 @@ async def add_plan_days(message: Message, state: FSMContext):
     await message.answer("💰 <b>Tarif narxini kiriting (faqat raqam, so'mda):</b>\n(Masalan: 50000)", reply_markup=get_cancel_kb(), parse_mode="HTML")
 
 @router.message(AddPlanStates.waiting_for_price)
-async def add_plan_price(message: Message, state: FSMContext):
+async def add_plan_price(message: Message, state: FSMContext, session: AsyncSession):
     if not message.text.isdigit():
         await message.answer("Iltimos, faqat raqam kiriting!")
         return
@@ -100,10 +112,10 @@ async def add_plan_price(message: Message, state: FSMContext):
     price_tiyin = int(message.text) * 100
     days = data['days'] if data['days'] > 0 else None
     
-    async with async_session() as session:
-        new_plan = Plan(name=data['name'], duration_days=days, price=price_tiyin, is_active=True)
-        session.add(new_plan)
-        await session.commit()
+    new_plan = Plan(name=data['name'], duration_days=days, price=price_tiyin, is_active=True)
+    session.add(new_plan)
+    await session.commit()
+    plan_catalog.invalidate()
     
     await state.clear()
     await message.answer(f"✅ <b>Tarif muvaffaqiyatli qo'shildi!</b>\n\nNomi: {data['name']}\nDavomiyligi: {data['days']} kun\nNarxi: {message.text} so'm", reply_markup=get_admin_keyboard(), parse_mode="HTML")
@@ -121,49 +133,138 @@ async def add_video_file(message: Message, state: FSMContext):
     await message.answer("📝 <b>Video sarlavhasini kiriting:</b>", reply_markup=get_cancel_kb(), parse_mode="HTML")
 
 @router.message(AddVideoStates.waiting_for_title)
-async def add_video_title(message: Message, state: FSMContext):
+async def add_video_title(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     
-    async with async_session() as session:
-        max_order = await session.scalar(select(func.max(Video.order))) or 0
-        new_video = Video(title=message.text, file_id=data['file_id'], order=max_order + 1, is_active=True)
-        session.add(new_video)
-        await session.commit()
+    max_order = await session.scalar(select(func.max(Video.order))) or 0
+    new_video = Video(title=message.text, file_id=data['file_id'], order=max_order + 1, is_active=True)
+    session.add(new_video)
+    await session.commit()
+    video_catalog.invalidate()
     
     await state.clear()
     await message.answer(f"✅ <b>Video dars qo'shildi!</b>\n\nSarlavha: {message.text}", reply_markup=get_admin_keyboard(), parse_mode="HTML")
 
 # --- Stats & Users ---
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values: list[int]) -> str:
+    peak = max(values) if values else 0
+    if not peak:
+        return SPARK_BLOCKS[0] * len(values)
+    return "".join(SPARK_BLOCKS[v * (len(SPARK_BLOCKS) - 1) // peak] for v in values)
+
 @router.callback_query(F.data == "admin_stats_advanced")
-async def show_stats_advanced(callback: CallbackQuery):
-    async with async_session() as session:
-        user_count = await session.scalar(select(func.count(User.id)))
-        active_subs = await session.scalar(select(func.count(Subscription.id)).where(Subscription.is_active == True))
-        expired_subs = await session.scalar(select(func.count(Subscription.id)).where(Subscription.is_active == False))
-        total_revenue = await session.scalar(select(func.sum(Payment.amount))) or 0
+async def show_stats_advanced(callback: CallbackQuery, session: AsyncSession):
+    # Everything comes from the incrementally maintained rollup, no table scans
+    stats = await get_stats(session, days=30)
+
+    revenue_30d = sum(day[4] for day in stats.daily)
+    signups_30d = sum(day[1] for day in stats.daily)
+    _, today_signups, today_subs, today_expired, today_revenue = stats.daily[-1]
         
     text = (
         f"📊 <b>Kengaytirilgan Statistika</b>\n\n"
-        f"👥 Jami foydalanuvchilar: <code>{user_count}</code>\n"
-        f"✅ Faol obunalar: <code>{active_subs}</code>\n"
-        f"❌ Muddati o'tgan: <code>{expired_subs}</code>\n"
-        f"💰 Umumiy tushum: <code>{total_revenue / 100:,.0f}</code> so'm\n"
+        f"👥 Jami foydalanuvchilar: <code>{stats.users}</code>\n"
+        f"✅ Faol obunalar: <code>{stats.active_subs}</code>\n"
+        f"❌ Muddati o'tgan: <code>{stats.expired_subs}</code>\n"
+        f"💰 Umumiy tushum: <code>{stats.revenue / 100:,.0f}</code> so'm\n\n"
+        f"📅 <b>Bugun:</b> +{today_signups} foydalanuvchi, +{today_subs} obuna, "
+        f"-{today_expired} tugagan, {today_revenue / 100:,.0f} so'm\n\n"
+        f"📈 <b>Oxirgi 30 kun:</b>\n"
+        f"<code>{sparkline([day[4] for day in stats.daily])}</code>\n"
+        f"💰 {revenue_30d / 100:,.0f} so'm, 👥 +{signups_30d}\n"
     )
     await callback.message.edit_text(text, reply_markup=get_admin_keyboard(), parse_mode="HTML")
 
+# --- User Browser ---
+# callback_data: "aul:<filter>:<cursor>", an empty cursor is the first page.
+# The search prefix lives in FSM data so it survives paging.
+USERS_PER_PAGE = 15
+
+def get_user_browser_keyboard(user_filter: str, next_cursor: str | None, search: str | None):
+    filter_row = [
+        InlineKeyboardButton(text=f"• {title}" if key == user_filter else title, callback_data=f"aul:{key}:")
+        for key, title in USER_FILTERS.items()
+    ]
+    search_row = [InlineKeyboardButton(text="🔍 Qidirish", callback_data="admin_user_search")]
+    if search:
+        search_row.append(InlineKeyboardButton(text="✖️ Qidiruvni tozalash", callback_data="admin_user_search_clear"))
+    nav_row = [InlineKeyboardButton(text="⏮ Boshiga", callback_data=f"aul:{user_filter}:")]
+    if next_cursor:
+        nav_row.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"aul:{user_filter}:{next_cursor}"))
+    return InlineKeyboardMarkup(inline_keyboard=[
+        filter_row,
+        search_row,
+        nav_row,
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data="admin_back_main")],
+    ])
+
+async def render_user_page(session: AsyncSession, state: FSMContext, user_filter: str = "a", cursor: str | None = None):
+    data = await state.get_data()
+    search = data.get("user_search")
+    rows, next_cursor = await browse_users(session, user_filter, search, cursor, USERS_PER_PAGE)
+
+    now = datetime.utcnow()
+    title = f"👥 <b>Foydalanuvchilar — {USER_FILTERS[user_filter]}</b>"
+    if search:
+        title += f"\n🔍 <code>{escape(search)}</code>"
+    text = title + "\n\n"
+    if not rows:
+        text += "Hech narsa topilmadi."
+    for row in rows:
+        if row.is_lifetime or (row.paid_until and row.paid_until > now):
+            sub_status = "✅"
+        elif row.paid_until:
+            sub_status = "⌛"
+        else:
+            sub_status = "❌"
+        username = f" @{escape(row.username)}" if row.username else ""
+        text += f"{sub_status} {escape(row.full_name or 'No Name')}{username} (<code>{row.id}</code>)\n"
+    return text, get_user_browser_keyboard(user_filter, next_cursor, search)
+
 @router.callback_query(F.data == "admin_user_list")
-async def admin_user_list(callback: CallbackQuery):
-    async with async_session() as session:
-        stmt = select(User, Subscription).outerjoin(Subscription).order_by(User.created_at.desc()).limit(15)
-        results = await session.execute(stmt)
-        rows = results.all()
-        
-    text = "👥 <b>Oxirgi 15 foydalanuvchi:</b>\n\n"
-    for user, sub in rows:
-        sub_status = "✅" if sub and sub.is_active else "❌"
-        text += f"{sub_status} {user.full_name or 'No Name'} (<code>{user.id}</code>)\n"
-    
-    await callback.message.edit_text(text, reply_markup=get_admin_keyboard(), parse_mode="HTML")
+async def admin_user_list(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    await state.update_data(user_search=None)
+    text, kb = await render_user_page(session, state)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("aul:"))
+async def admin_user_page(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    _, user_filter, cursor = callback.data.split(":", 2)
+    if user_filter not in USER_FILTERS:
+        user_filter = "a"
+    text, kb = await render_user_page(session, state, user_filter, cursor or None)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_user_search")
+async def admin_user_search(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    await state.set_state(AdminStates.waiting_for_user_search)
+    await callback.message.edit_text("🔍 <b>Username yoki ism boshini kiriting:</b>", reply_markup=get_cancel_kb(), parse_mode="HTML")
+
+@router.message(AdminStates.waiting_for_user_search)
+async def admin_user_search_query(message: Message, state: FSMContext, session: AsyncSession):
+    # Leave the state but keep the data: the prefix is reused while paging
+    await state.set_state(None)
+    await state.update_data(user_search=(message.text or "").strip()[:64] or None)
+    text, kb = await render_user_page(session, state)
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@router.callback_query(F.data == "admin_user_search_clear")
+async def admin_user_search_clear(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    await state.update_data(user_search=None)
+    text, kb = await render_user_page(session, state)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
 
 @router.callback_query(F.data == "admin_broadcast")
 async def start_broadcast(callback: CallbackQuery, state: FSMContext):
@@ -171,7 +272,7 @@ async def start_broadcast(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("📢 <b>Barcha foydalanuvchilarga yuborilishi kerak bo'lgan xabarni yozing:</b>\n\n(Har qanday media qabul qilinadi)", reply_markup=get_cancel_kb(), parse_mode="HTML")
 
 @router.message(AdminStates.waiting_for_broadcast)
-async def process_broadcast(message: Message, state: FSMContext):
+async def process_broadcast(message: Message, state: FSMContext, session: AsyncSession):
     if message.text == "/cancel": 
         await state.clear()
         await message.answer("❌ Bekor qilindi.", reply_markup=get_admin_keyboard())
@@ -179,19 +280,20 @@ async def process_broadcast(message: Message, state: FSMContext):
 
     await state.clear()
     sent_msg = await message.answer("⏳ Yuborilmoqda...")
-    async with async_session() as session:
-        user_ids = (await session.scalars(select(User.id))).all()
-    
-    success, failed = 0, 0
-    for uid in user_ids:
-        try:
-            await message.copy_to(uid)
-            success += 1
-        except: failed += 1
+    job = await create_job(session, message.chat.id, message.message_id, sent_msg.chat.id, sent_msg.message_id)
     
-    await sent_msg.edit_text(f"📢 <b>Yuborildi!</b>\n\n✅ {success}\n❌ {failed}", parse_mode="HTML")
+    # Runs in the background: rate limited, persisted and resumed after a restart.
+    # With WORKERS > 1 worker 0 picks it up instead.
+    start_job(message.bot, job.id)
     await message.answer("🛠 Admin Panel", reply_markup=get_admin_keyboard())
 
+@router.callback_query(F.data.startswith("broadcast_cancel:"))
+async def broadcast_cancel(callback: CallbackQuery, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    await cancel_job(session, int(callback.data.split(":")[1]))
+    await callback.answer("⛔ To'xtatilmoqda...")
+
 @router.callback_query(F.data == "admin_toggle_protection")
 async def toggle_protection(callback: CallbackQuery):
     try:
@@ -203,11 +305,63 @@ async def toggle_protection(callback: CallbackQuery):
     except Exception as e:
         await callback.answer(f"Xatolik: {e}", show_alert=True)
 
+def get_plans_admin_keyboard():
+    # One toggle button per plan, then the usual settings menu
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{'🟢' if p.is_active else '⚪'} {p.name}",
+            callback_data=f"admin_plan_toggle:{p.id}"
+        )]
+        for p in plan_catalog.plans
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows + get_settings_keyboard().inline_keyboard)
+
+async def render_plans(callback: CallbackQuery):
+    await plan_catalog.ensure_fresh()
+    text = "📋 <b>Mavjud Tariflar:</b>\n\n"
+    for p in plan_catalog.plans:
+        status = "" if p.is_active else " (o'chirilgan)"
+        text += f"- {escape(p.name)}: {p.duration_days if p.duration_days else 'Umrbod'} kun, {p.price/100:,.0f} so'm{status}\n"
+    text += "\nTarifni yoqish/o'chirish uchun ustiga bosing."
+    await callback.message.edit_text(text, reply_markup=get_plans_admin_keyboard(), parse_mode="HTML")
+
 @router.callback_query(F.data == "admin_list_plans")
 async def list_plans(callback: CallbackQuery):
-    async with async_session() as session:
-        plans = (await session.scalars(select(Plan))).all()
-    text = "📋 <b>Mavjud Tariflar:</b>\n\n"
-    for p in plans:
-        text += f"- {p.name}: {p.duration_days if p.duration_days else 'Umrbod'} kun, {p.price/100:,.0f} so'm\n"
-    await callback.message.edit_text(text, reply_markup=get_settings_keyboard(), parse_mode="HTML")
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    await render_plans(callback)
+
+@router.callback_query(F.data.startswith("admin_plan_toggle:"))
+async def toggle_plan(callback: CallbackQuery, session: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer()
+    plan_id = int(callback.data.split(":")[1])
+    await session.execute(update(Plan).where(Plan.id == plan_id).values(is_active=~Plan.is_active))
+    await session.commit()
+    plan_catalog.invalidate()
+    await render_plans(callback)
+    await callback.answer()
+
+@router.message(Command("profile"))
+async def profile_command(message: Message):
+    # /profile — status, /profile 5 — profile ~5% of updates, /profile 0 — stop and write the file
+    if not is_admin(message.from_user.id):
+        return
+    args = (message.text or "").split()
+    if len(args) > 1:
+        try:
+            percent = float(args[1].rstrip("%"))
+        except ValueError:
+            await message.answer("Foydalanish: <code>/profile 5</code> (foiz) yoki <code>/profile 0</code>", parse_mode="HTML")
+            return
+        path = profiler.set_percent(percent)
+        if path:
+            await message.answer(f"⏹ Profiling to'xtatildi. Natija: <code>{escape(path)}</code>", parse_mode="HTML")
+            return
+    status = f"{profiler.percent:g}% yangilanishlar" if profiler.enabled else "o'chirilgan"
+    await message.answer(
+        f"🩺 <b>Profiling:</b> {status}\n"
+        f"Jami namunalar: {profiler.samples}\n"
+        f"Papka: <code>{escape(profiler.directory)}</code>",
+        parse_mode="HTML"
+    )
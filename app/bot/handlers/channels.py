@@ -0,0 +1,15 @@
+from aiogram import Router
+from aiogram.types import ChatMemberUpdated
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services import membership
+from app.services.membership import record_status
+
+router = Router()
+
+@router.chat_member()
+async def channel_member_updated(update: ChatMemberUpdated, session: AsyncSession):
+    # Only channels where we are admin send these; ignore the private group and anything else
+    if update.chat.id not in membership.observed_channels.values():
+        return
+
+    await record_status(session, update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status)
@@ -2,35 +2,40 @@ from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, PreCheckoutQuery, SuccessfulPayment, LabeledPrice, ContentType, ChatJoinRequest
 from aiogram.filters import CommandStart, Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from app.db import async_session
 from app.db.models import User, Plan, Subscription, Payment, Video
-from app.services.subscriptions import get_active_subscription, create_subscription
+from app.services.subscriptions import get_active_subscription, get_entitlement, record_payment
+from app.services.catalog import video_catalog, plan_catalog, plan_id_from_payload
+from app.services import metrics
+from app.services.invites import get_invite_link
+from app.services.stats import bump_stats
+from app.services.users import register_user
 from app.config import settings
-from app.bot.keyboards import get_main_menu, get_plans_keyboard, get_videos_keyboard, get_welcome_keyboard, get_subscription_renewal_keyboard
+from app.bot.keyboards import (
+    get_main_menu, get_welcome_keyboard, get_subscription_renewal_keyboard,
+    get_subscription_status_keyboard, get_invite_link_keyboard,
+)
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime
+import logging
+import time
 
 router = Router()
+logger = logging.getLogger(__name__)
 
 @router.message(CommandStart())
-async def command_start_handler(message: Message):
-    async with async_session() as session:
-        # Check/Create user
-        user = await session.execute(select(User).where(User.id == message.from_user.id))
-        user = user.scalar_one_or_none()
-        if not user:
-            new_user = User(
-                id=message.from_user.id,
-                username=message.from_user.username,
-                full_name=message.from_user.full_name
-            )
-            session.add(new_user)
-            await session.commit()
-    
-    # Check if user has active sub
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, message.from_user.id)
+async def command_start_handler(message: Message, session: AsyncSession):
+    # Create user in one INSERT ... ON CONFLICT DO NOTHING; profile changes of known
+    # users are written behind by UserProfileMiddleware
+    created = await register_user(session, message.from_user.id, message.from_user.username, message.from_user.full_name)
+    if created:
+        await bump_stats(session, signups=1)
+        # Release the write lock before talking to Telegram
+        await session.commit()
+
+    # Check if user has active sub (a brand new user can't have one)
+    active_sub = None if created else await get_entitlement(session, message.from_user.id)
     
     # Provide the Welcome screen first (as requested) regardless of sub, or skip to menu if sub?
     # User request "Start -> Azolik -> Plans" implies a flow.
@@ -71,11 +76,9 @@ async def check_permissions(callback: CallbackQuery):
 @router.message(F.text == "🚀 KURSDA O'QISHNI BOSHLASH")
 async def start_button_handler(message: Message):
     # This button is clicked. Middleware checked membership.
-    # Show plans.
-    async with async_session() as session:
-        plans_result = await session.execute(select(Plan).where(Plan.is_active == True))
-        plans = plans_result.scalars().all()
-        
+    # Show plans (keyboard prebuilt by the plan catalog).
+    await plan_catalog.ensure_fresh()
+
     text = (
         "🎓 <b>AI Darslar Tariflari</b>\n\n"
         "Qaysi paket sizga mos?\n\n"
@@ -91,7 +94,7 @@ async def start_button_handler(message: Message):
         "⚠️ Jonli darslar guruhida joylar cheklangan.\n"
         "Tanlang 👇"
     )
-    await message.answer(text, reply_markup=get_plans_keyboard(plans), parse_mode="HTML")
+    await message.answer(text, reply_markup=plan_catalog.keyboard, parse_mode="HTML")
 
 @router.message(F.text == "ℹ️ Loyiha haqida")
 async def about_handler(message: Message):
@@ -106,11 +109,11 @@ async def about_handler(message: Message):
 @router.callback_query(F.data.startswith("buy_plan:"))
 async def process_payment(callback: CallbackQuery):
     plan_id = int(callback.data.split(":")[1])
-    async with async_session() as session:
-        plan = await session.get(Plan, plan_id)
-        if not plan:
-            await callback.answer("Tarif topilmadi.", show_alert=True)
-            return
+    await plan_catalog.ensure_fresh()
+    plan = plan_catalog.get(plan_id)
+    if not plan or not plan.is_active:
+        await callback.answer("Tarif topilmadi.", show_alert=True)
+        return
 
     # Text before Invoice
     msg_text = (
@@ -149,32 +152,73 @@ async def process_payment(callback: CallbackQuery):
         await callback.message.answer(f"Xatolik: To'lov tizimi ishlamayapti.\nSabab: {e.message}")
         await callback.answer()
 
+PRE_CHECKOUT_ERRORS = {
+    "payload": "To'lov ma'lumoti noto'g'ri. Iltimos, tarifni qaytadan tanlang.",
+    "unknown_plan": "Bu tarif endi mavjud emas. Iltimos, tarifni qaytadan tanlang.",
+    "inactive_plan": "Bu tarif hozir sotuvda emas. Iltimos, boshqa tarifni tanlang.",
+    "currency": "To'lov valyutasi noto'g'ri. Iltimos, tarifni qaytadan tanlang.",
+    "amount": "Tarif narxi o'zgargan. Iltimos, tarifni qaytadan tanlang.",
+}
+
 @router.pre_checkout_query()
 async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery):
-    await pre_checkout_query.answer(ok=True)
+    # Validated against the in-memory plan table only; an aged-out snapshot is refreshed
+    # in the background, admin changes in this process are picked up right away
+    started = time.perf_counter()
+    await plan_catalog.ensure_fresh(allow_stale=True)
+    reason = plan_catalog.check_invoice(
+        pre_checkout_query.invoice_payload,
+        pre_checkout_query.total_amount,
+        pre_checkout_query.currency,
+        settings.CURRENCY,
+    )
+    metrics.pre_checkout_duration.observe(time.perf_counter() - started, result=reason or "ok")
+
+    if reason is None:
+        await pre_checkout_query.answer(ok=True)
+        return
+    logger.warning(
+        f"Pre-checkout rejected ({reason}): user {pre_checkout_query.from_user.id}, "
+        f"payload {pre_checkout_query.invoice_payload!r}, amount {pre_checkout_query.total_amount} {pre_checkout_query.currency}"
+    )
+    await pre_checkout_query.answer(ok=False, error_message=PRE_CHECKOUT_ERRORS[reason])
 
 @router.message(F.successful_payment)
-async def successful_payment_handler(message: Message):
+async def successful_payment_handler(message: Message, session: AsyncSession):
     payment_info = message.successful_payment
     payload = payment_info.invoice_payload
-    plan_id = int(payload.split(":")[1]) if payload.startswith("plan_id:") else None
+    plan_id = plan_id_from_payload(payload)
     
     if not plan_id:
         await message.answer("Xatolik: Noto'g'ri to'lov ma'lumoti.")
         return
 
-    async with async_session() as session:
-        new_payment = Payment(
-            user_id=message.from_user.id,
-            amount=payment_info.total_amount,
-            currency=payment_info.currency,
-            provider=settings.PROVIDER_TOKEN,
-            tg_charge_id=payment_info.telegram_payment_charge_id,
-        )
-        session.add(new_payment)
-        
-        new_sub = await create_subscription(session, message.from_user.id, plan_id)
-        await session.commit()
+    await plan_catalog.ensure_fresh()
+    # Deactivated plans still count here: the invoice was issued while the plan was on sale
+    plan = plan_catalog.get(plan_id)
+    if plan is None:
+        logger.error(f"Payment {payment_info.telegram_payment_charge_id} for unknown plan {plan_id}")
+        await message.answer("Xatolik: Noto'g'ri to'lov ma'lumoti.")
+        return
+
+    # Payment, subscription, entitlement and stats in one transaction. Entitlement cache and
+    # expiry timer are updated once this commits.
+    result = await record_payment(
+        session,
+        message.from_user.id,
+        plan,
+        amount=payment_info.total_amount,
+        currency=payment_info.currency,
+        provider=settings.PROVIDER_TOKEN,
+        charge_id=payment_info.telegram_payment_charge_id,
+        username=message.from_user.username,
+        full_name=message.from_user.full_name,
+    )
+    await session.commit()
+    if result is None:
+        # Redelivered update; the user has already been answered
+        logger.info(f"Duplicate payment {payment_info.telegram_payment_charge_id} ignored")
+        return
 
     text = (
         "🎉 <b>Tabriklaymiz! To‘lov qabul qilindi.</b>\n\n"
@@ -189,33 +233,22 @@ async def successful_payment_handler(message: Message):
     
     # Provide immediate link after payment
     try:
-        invite_link = await message.bot.create_chat_invite_link(
-            chat_id=settings.PRIVATE_GROUP_ID,
-            creates_join_request=True,
-            name=f"New Member {message.from_user.id}"
-        )
-        
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        link_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔗 Guruhga kirish so'rovi", url=invite_link.invite_link)]
-        ])
-        
-        await message.answer("🎁 To'lov uchun rahmat! Guruhga kirish uchun pastdagi tugmani bosing va kirish so'rovini yuboring. Bot sizni avtomatik tasdiqlaydi:", reply_markup=link_kb)
+        invite_link = await get_invite_link(session, message.bot, message.from_user.id)
+        await message.answer("🎁 To'lov uchun rahmat! Guruhga kirish uchun pastdagi tugmani bosing va kirish so'rovini yuboring. Bot sizni avtomatik tasdiqlaydi:", reply_markup=get_invite_link_keyboard(invite_link))
     except Exception as e:
         logger.error(f"Error creating link after payment: {e}")
 
 @router.message(F.text == "🎬 Video darslar")
-async def list_videos(message: Message):
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, message.from_user.id)
-        
-        if not active_sub:
-             await message.answer("Video darslarni ko'rish uchun obuna bo'lishingiz kerak.", reply_markup=get_subscription_renewal_keyboard())
-             return
+async def list_videos(message: Message, session: AsyncSession):
+    active_sub = await get_entitlement(session, message.from_user.id)
+    
+    if not active_sub:
+         await message.answer("Video darslarni ko'rish uchun obuna bo'lishingiz kerak.", reply_markup=get_subscription_renewal_keyboard())
+         return
+
+    await video_catalog.ensure_fresh()
+    keyboard, _ = video_catalog.page(1)
 
-        videos_res = await session.execute(select(Video).where(Video.is_active == True).order_by(Video.order))
-        videos = videos_res.scalars().all()
-        
     text = (
         "🎬 **Video Darslar**\n\n"
         "Bosqichma-bosqich o‘rganing:\n\n"
@@ -228,25 +261,19 @@ async def list_videos(message: Message):
         "Kerakli bo‘limni tanlang 👇"
     )
     
-    if not videos:
+    if keyboard is None:
         await message.answer("Hozircha video darslar yo'q.")
         return
 
-    page = 1
-    per_page = 5
-    total_pages = (len(videos) + per_page - 1) // per_page
-    current_videos = videos[(page-1)*per_page : page*per_page]
-    
-    await message.answer(text, reply_markup=get_videos_keyboard(current_videos, page, total_pages), parse_mode="HTML")
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 @router.message(F.text == "🔴 Jonli guruhga kirish")
-async def group_access_handler(message: Message):
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, message.from_user.id)
-        
-        if not active_sub:
-             await message.answer("Guruhga kirish uchun obuna bo'lishingiz kerak.", reply_markup=get_subscription_renewal_keyboard())
-             return
+async def group_access_handler(message: Message, session: AsyncSession):
+    active_sub = await get_entitlement(session, message.from_user.id)
+    
+    if not active_sub:
+         await message.answer("Guruhga kirish uchun obuna bo'lishingiz kerak.", reply_markup=get_subscription_renewal_keyboard())
+         return
 
     text = (
         "🔴 **Jonli Dars Guruhi**\n\n"
@@ -259,37 +286,22 @@ async def group_access_handler(message: Message):
     )
     
     try:
-        # Create Join Request Invite Link (Lock 2)
-        invite_link = await message.bot.create_chat_invite_link(
-             chat_id=settings.PRIVATE_GROUP_ID,
-             creates_join_request=True,
-             name=f"Access Request {message.from_user.id}"
-        )
-        
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔗 Guruhga kirish so'rovi", url=invite_link.invite_link)]
-        ])
-        
-        await message.answer(text, reply_markup=kb, parse_mode="HTML")
+        # Join Request Invite Link (Lock 2), reused while it is valid
+        invite_link = await get_invite_link(session, message.bot, message.from_user.id)
+        await message.answer(text, reply_markup=get_invite_link_keyboard(invite_link), parse_mode="HTML")
     except Exception as e:
         await message.answer(f"Guruh havolasini yaratishda xatolik: {e}\nAdmin bilan bog'laning.")
 
 
 @router.message(F.text == "📊 Mening obunam")
-async def subscription_status_handler(message: Message):
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, message.from_user.id)
-        if not active_sub:
-             await message.answer("Sizda hozirda faol obuna yo'q.", reply_markup=get_subscription_renewal_keyboard())
-             return
-        
-        # We need plan name. Eager load or join?
-        # Subscription model has `plan` relationship but default lazy loading might fail in async without specific options.
-        # Let's fetch plan manually or use joinedload option in get_active_subscription query.
-        # For simplicity, simple fetch:
-        plan = await session.get(Plan, active_sub.plan_id)
-        
+async def subscription_status_handler(message: Message, session: AsyncSession):
+    # The plan comes eager-loaded with the subscription (single query)
+    active_sub = await get_active_subscription(session, message.from_user.id)
+    if not active_sub:
+         await message.answer("Sizda hozirda faol obuna yo'q.", reply_markup=get_subscription_renewal_keyboard())
+         return
+    plan = active_sub.plan
+
     start_str = active_sub.start_date.strftime("%d.%m.%Y")
     end_str = active_sub.end_date.strftime("%d.%m.%Y") if active_sub.end_date else "Cheksiz"
     status = "✅ Aktiv" if active_sub.is_active else "❌ Nofaol"
@@ -304,12 +316,7 @@ async def subscription_status_handler(message: Message):
     )
     
     # Buttons: Renew, Back
-    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Uzaytirish", callback_data="buy_subscription")], 
-    ])
-    
-    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+    await message.answer(text, reply_markup=get_subscription_status_keyboard(), parse_mode="HTML")
 
 @router.callback_query(F.data == "renew_subscription")
 async def renew_subscription_cb(callback: CallbackQuery):
@@ -324,19 +331,19 @@ async def back_home(callback: CallbackQuery):
 
 # ... Video watch handlers remain same ...
 @router.callback_query(F.data.startswith("watch_video:"))
-async def watch_video(callback: CallbackQuery):
+async def watch_video(callback: CallbackQuery, session: AsyncSession):
     video_id = int(callback.data.split(":")[1])
     
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, callback.from_user.id)
-        if not active_sub:
-            await callback.answer("Obunangiz yo'q yoki tugagan.", show_alert=True)
-            return
+    active_sub = await get_entitlement(session, callback.from_user.id)
+    if not active_sub:
+        await callback.answer("Obunangiz yo'q yoki tugagan.", show_alert=True)
+        return
             
-        video = await session.get(Video, video_id)
-        if not video:
-            await callback.answer("Video topilmadi.", show_alert=True)
-            return
+    await video_catalog.ensure_fresh()
+    video = video_catalog.get(video_id)
+    if not video:
+        await callback.answer("Video topilmadi.", show_alert=True)
+        return
             
     try:
         await callback.message.answer_video(
@@ -353,29 +360,23 @@ async def watch_video(callback: CallbackQuery):
 async def videos_pagination(callback: CallbackQuery):
     page = int(callback.data.split(":")[1])
     
-    async with async_session() as session:
-        videos_res = await session.execute(select(Video).where(Video.is_active == True).order_by(Video.order))
-        videos = videos_res.scalars().all()
-        
-    per_page = 5
-    total_pages = (len(videos) + per_page - 1) // per_page
-    
-    if page < 1: page = 1
-    if page > total_pages: page = total_pages
-    
-    current_videos = videos[(page-1)*per_page : page*per_page]
+    # Served from the prebuilt catalog pages, no DB access unless an admin changed the catalog
+    await video_catalog.ensure_fresh()
+    keyboard, page = video_catalog.page(page)
+    if keyboard is None:
+        await callback.answer("Hozircha video darslar yo'q.")
+        return
     
-    await callback.message.edit_reply_markup(reply_markup=get_videos_keyboard(current_videos, page, total_pages))
+    await callback.message.edit_reply_markup(reply_markup=keyboard)
     await callback.answer()
 
 @router.chat_join_request()
-async def chat_join_request_handler(update: ChatJoinRequest):
+async def chat_join_request_handler(update: ChatJoinRequest, session: AsyncSession):
     if update.chat.id != settings.PRIVATE_GROUP_ID:
         return
 
-    async with async_session() as session:
-        active_sub = await get_active_subscription(session, update.from_user.id)
-        
+    active_sub = await get_entitlement(session, update.from_user.id)
+
     if active_sub:
         await update.approve()
         try:
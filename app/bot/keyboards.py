@@ -1,6 +1,11 @@
+from functools import cache, lru_cache
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from app.db.models import Plan, Video
 
+# Markups are immutable pydantic objects, so the static ones are built once and shared.
+# The undecorated builders stay reachable as `fn.__wrapped__` (used by the benchmarks).
+
+@cache
 def get_welcome_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -11,6 +16,7 @@ def get_welcome_keyboard():
         input_field_placeholder="Quyidagi tugmani bosing 👇"
     )
 
+@lru_cache(maxsize=64)
 def get_check_subscription_keyboard(channel_url: str):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -19,6 +25,7 @@ def get_check_subscription_keyboard(channel_url: str):
         ]
     )
 
+@cache
 def get_main_menu():
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -28,20 +35,20 @@ def get_main_menu():
         resize_keyboard=True
     )
 
+def plan_icon(name: str) -> str:
+    lowered = name.lower()
+    if "1" in name or "bir" in lowered: return "🥉"
+    if "3" in name or "uch" in lowered: return "🥈"
+    if "lifetime" in lowered or "umrbod" in lowered: return "🥇"
+    return "💎"
+
 def get_plans_keyboard(plans: list[Plan]):
+    # Built by PlanCatalog once per plan change, not per message
     keyboard = []
     # Sort plans: 1 Month, 3 Month, Lifetime (assuming length/price correlates)
-    plans.sort(key=lambda x: x.price)
-
-    for plan in plans:
+    for plan in sorted(plans, key=lambda x: x.price):
         price_display = f"{plan.price / 100:,.0f} so'm".replace(",", " ")
-        
-        icon = "💎"
-        if "1" in plan.name or "bir" in plan.name.lower(): icon = "🥉"
-        elif "3" in plan.name or "uch" in plan.name.lower(): icon = "🥈"
-        elif "lifetime" in plan.name.lower() or "umrbod" in plan.name.lower(): icon = "🥇"
-        
-        btn_text = f"{icon} {plan.name} ({price_display})"
+        btn_text = f"{plan_icon(plan.name)} {plan.name} ({price_display})"
         keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"buy_plan:{plan.id}")])
     
     # Back is usually good, but the flow is simpler without deep nest.
@@ -68,9 +75,23 @@ def get_videos_keyboard(videos: list[Video], page: int = 1, total_pages: int = 1
         
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@cache
 def get_subscription_renewal_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="💳 Obunani yangilash", callback_data="renew_subscription")]
         ]
     )
+
+@cache
+def get_subscription_status_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Uzaytirish", callback_data="buy_subscription")],
+    ])
+
+@lru_cache(maxsize=1024)
+def get_invite_link_keyboard(invite_link: str):
+    # Invite links are reused per user for days (services.invites), so this hits often
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔗 Guruhga kirish so'rovi", url=invite_link)]
+    ])
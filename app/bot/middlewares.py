@@ -1,43 +1,142 @@
 from aiogram import BaseMiddleware
+from aiogram.fsm.middleware import FSMContextMiddleware
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramAPIError
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app.db.utils import query_counter
+from app.services.cache import TTLCache
+from app.services import membership, metrics, tracing
+from app.services.membership import MEMBER_STATUSES, normalize_channels, get_recorded_statuses, record_status
+from app.services.users import profile_buffer
+import asyncio
 import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 class ChannelMembershipMiddleware(BaseMiddleware):
-    def __init__(self, public_channel_usernames: str):
-        # Split by comma and strip whitespace
-        self.channel_usernames = [ch.strip() for ch in public_channel_usernames.split(',') if ch.strip()]
-        # Ensure they start with @ or are IDs (ids usually don't need @, usernames do)
-        self.normalized_channels = []
-        for ch in self.channel_usernames:
-            if not ch.startswith("-100") and not ch.startswith("@"):
-                 self.normalized_channels.append(f"@{ch}")
-            else:
-                 self.normalized_channels.append(ch)
+    def __init__(
+        self,
+        public_channel_usernames: str,
+        member_ttl: float = 300,
+        non_member_ttl: float = 30,
+        channel_info_ttl: float = 3600,
+        maxsize: int = 50000,
+    ):
+        self.normalized_channels = normalize_channels(public_channel_usernames)
+
+        # (user_id, channel) -> is member. Non-members are kept for a shorter time,
+        # and the "✅ Tekshirish" button always drops the user's entries.
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.membership_cache = TTLCache(maxsize=maxsize, ttl=member_ttl)
+        # channel -> (button text, url)
+        self.channel_info_cache = TTLCache(maxsize=max(len(self.normalized_channels), 1) * 4, ttl=channel_info_ttl)
+        metrics.caches.register("channel_membership", self.membership_cache)
+        metrics.caches.register("channel_info", self.channel_info_cache)
+
+    def invalidate_user(self, user_id: int):
+        for channel in self.normalized_channels:
+            self.membership_cache.pop((user_id, channel))
+
+    async def fetch_membership(self, bot, channel: str, user_id: int) -> tuple[bool, str | None]:
+        # (is member, status fresh from the API or None when answered from cache / on error)
+        key = (user_id, channel)
+        cached = self.membership_cache.get(key)
+        if cached is not None:
+            return cached, None
+        try:
+            member = await bot.get_chat_member(channel, user_id)
+        except TelegramAPIError as e:
+            logging.error(f"Error checking membership for {channel}: {e}")
+            # If bot cannot check (not admin or channel invalid), maybe skip or fail secure?
+            # Failing secure (adding to missing) is safer for business, but annoying if config is wrong.
+            # Let's add to missing so admin notices. Errors are not cached.
+            return False, None
+        is_member = member.status in MEMBER_STATUSES
+        self.membership_cache.set(key, is_member, ttl=self.member_ttl if is_member else self.non_member_ttl)
+        return is_member, member.status
+
+    async def get_missing_channels(self, bot, session: AsyncSession, user_id: int, force_refresh: bool = False) -> list[str]:
+        known: dict[str, bool] = {}
+        observed = {
+            ch: membership.observed_channels[ch]
+            for ch in self.normalized_channels
+            if ch in membership.observed_channels
+        }
+        if observed:
+            # One indexed lookup covers every channel we receive chat_member updates for
+            recorded = await get_recorded_statuses(session, user_id, list(observed.values()))
+            for ch, chat_id in observed.items():
+                status = recorded.get(chat_id)
+                if status is None:
+                    continue
+                is_member = status in MEMBER_STATUSES
+                # A missed update must not lock the user out forever: re-check on demand
+                if is_member or not force_refresh:
+                    known[ch] = is_member
+
+        pending = [ch for ch in self.normalized_channels if ch not in known]
+        # API lookups run concurrently; the session is only used afterwards, one statement at a time
+        fetched = await asyncio.gather(*(self.fetch_membership(bot, ch, user_id) for ch in pending))
+        for ch, (is_member, status) in zip(pending, fetched):
+            known[ch] = is_member
+            chat_id = membership.observed_channels.get(ch)
+            if status is not None and chat_id is not None:
+                # Seed the local index; chat_member updates keep it current from now on.
+                # Committed by DbSessionMiddleware with the rest of the update.
+                await record_status(session, chat_id, user_id, status)
+        return [ch for ch in self.normalized_channels if not known[ch]]
+
+    async def get_channel_button(self, bot, channel: str) -> InlineKeyboardButton:
+        cached = self.channel_info_cache.get(channel)
+        if cached is None:
+            # We need a link. If it's a private channel ID (-100...), we can't easily guess link without InviteLink cache.
+            # Assuming public usernames for now as per config name PUBLIC_CHANNEL_USERNAMES.
+            btn_text = "📢 Kanalga a'zo bo'lish"
+            url = f"https://t.me/{channel.strip('@')}"
+            try:
+                chat_obj = await bot.get_chat(channel)
+                btn_text = f"📢 {chat_obj.title}"
+                if chat_obj.username:
+                    url = f"https://t.me/{chat_obj.username}"
+                # If private channel without username, we need invite link.
+                elif chat_obj.invite_link:
+                    url = chat_obj.invite_link
+                cached = (btn_text, url)
+                self.channel_info_cache.set(channel, cached)
+            except TelegramAPIError as e:
+                logging.warning(f"Could not fetch chat info for {channel}: {e}")
+                return InlineKeyboardButton(text=btn_text, url=url)
+        btn_text, url = cached
+        return InlineKeyboardButton(text=btn_text, url=url)
+
+    def cache_stats(self) -> dict:
+        return {
+            "membership": self.membership_cache.stats(),
+            "channel_info": self.channel_info_cache.stats(),
+        }
 
     async def __call__(self, handler, event, data):
         if not isinstance(event, (Message, CallbackQuery)):
             return await handler(event, data)
+        # Telegram has already charged the user; the payment is recorded whatever their channels
+        if isinstance(event, Message) and event.successful_payment:
+            return await handler(event, data)
 
         # Skip check for /start if you want, but requirement says mandatory.
         # But allow /start deep links if needed? For now strict lock.
 
         bot = data["bot"]
         user_id = event.from_user.id
-        
-        missing_channels = []
 
-        for channel in self.normalized_channels:
-            try:
-                member = await bot.get_chat_member(channel, user_id)
-                if member.status not in ("member", "administrator", "creator"):
-                    missing_channels.append(channel)
-            except TelegramAPIError as e:
-                logging.error(f"Error checking membership for {channel}: {e}")
-                # If bot cannot check (not admin or channel invalid), maybe skip or fail secure?
-                # Failing secure (adding to missing) is safer for business, but annoying if config is wrong.
-                # Let's add to missing so admin notices.
-                missing_channels.append(channel)
+        # The user says they've just joined: don't trust the cached answer.
+        force_refresh = isinstance(event, CallbackQuery) and event.data == "check_subscription"
+        if force_refresh:
+            self.invalidate_user(user_id)
+
+        missing_channels = await self.get_missing_channels(bot, data["session"], user_id, force_refresh=force_refresh)
 
         if not missing_channels:
             return await handler(event, data)
@@ -47,30 +146,9 @@ class ChannelMembershipMiddleware(BaseMiddleware):
             "🔐 <b>Botdan qoydalanish uchun quyidagi kanallarga a’zo bo‘ling:</b>\n\n"
             "A’zo bo‘lib, so‘ng “✅ Tekshirish” tugmasini bosing."
         )
-        
-        keyboard = []
-        for ch in missing_channels:
-            # We need a link. If it's a private channel ID (-100...), we can't easily guess link without InviteLink cache.
-            # Assuming public usernames for now as per config name PUBLIC_CHANNEL_USERNAMES.
-            # If ID is used, impossible to give link unless we fetch chat.
-            
-            btn_text = "📢 Kanalga a'zo bo'lish"
-            url = f"https://t.me/{ch.strip('@')}"
-            
-            # Try to get chat title if possible (adds latency, but better UX)
-            try:
-                chat_obj = await bot.get_chat(ch)
-                btn_text = f"📢 {chat_obj.title}"
-                if chat_obj.username:
-                    url = f"https://t.me/{chat_obj.username}"
-                # If private channel without username, we need invite link.
-                elif chat_obj.invite_link:
-                    url = chat_obj.invite_link
-            except:
-                pass
-
-            keyboard.append([InlineKeyboardButton(text=btn_text, url=url)])
 
+        buttons = await asyncio.gather(*(self.get_channel_button(bot, ch) for ch in missing_channels))
+        keyboard = [[btn] for btn in buttons]
         keyboard.append([InlineKeyboardButton(text="✅ Tekshirish", callback_data="check_subscription")])
         
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -90,3 +168,120 @@ class ChannelMembershipMiddleware(BaseMiddleware):
                  await event.message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
                  await event.answer()
         return
+
+class ScopedFSMContextMiddleware(FSMContextMiddleware):
+    # aiogram's FSM middleware loads the sender's state for every update. Only the update types
+    # in `stateful_updates` have handlers that use FSM, the rest (pre_checkout_query, chat_member...)
+    # skip the lookup and the isolation lock. Handlers for them can't take `state`.
+    def __init__(self, storage, events_isolation, strategy, stateful_updates):
+        super().__init__(storage=storage, events_isolation=events_isolation, strategy=strategy)
+        self.stateful_updates = frozenset(stateful_updates)
+
+    async def __call__(self, handler, event, data):
+        if event.event_type not in self.stateful_updates:
+            data["fsm_storage"] = self.storage
+            return await handler(event, data)
+        return await super().__call__(handler, event, data)
+
+class UserProfileMiddleware(BaseMiddleware):
+    # Outer update middleware: hands the sender's profile to the write-behind buffer
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            profile_buffer.observe(user.id, user.username, user.full_name)
+        return await handler(event, data)
+
+class DbSessionMiddleware(BaseMiddleware):
+    # Outer update middleware: one session per update, committed or rolled back once at the end.
+    # Handlers that write before slow Telegram calls may commit early; then there is nothing left here.
+    def __init__(self, session_maker: async_sessionmaker, log_queries: bool = False):
+        self.session_maker = session_maker
+        self.log_queries = log_queries
+
+    async def __call__(self, handler, event, data):
+        counter = [0]
+        token = query_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            async with self.session_maker() as session:
+                data["session"] = session
+                try:
+                    result = await handler(event, data)
+                except Exception:
+                    await session.rollback()
+                    raise
+                if session.in_transaction():
+                    await session.commit()
+                return result
+        finally:
+            query_counter.reset(token)
+            logger.log(
+                logging.INFO if self.log_queries else logging.DEBUG,
+                f"Update {getattr(event, 'update_id', '?')}: {counter[0]} SQL statements, "
+                f"{(time.perf_counter() - started) * 1000:.1f} ms"
+            )
+
+class TracingMiddleware(BaseMiddleware):
+    # Outermost update middleware: span tree per update, slow-update log, sampled profiling
+    def __init__(self, slow_update_ms: float):
+        self.slow_threshold = slow_update_ms / 1000
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        attrs = {
+            "update_id": getattr(event, "update_id", None),
+            "type": getattr(event, "event_type", None),
+            "user_id": user.id if user else None,
+        }
+        with tracing.trace_update("update", self.slow_threshold, **attrs), tracing.profiler.maybe_profile():
+            return await handler(event, data)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Outer update middleware: counts updates by type and times the whole pipeline
+    async def __call__(self, handler, event, data):
+        update_type = getattr(event, "event_type", None) or "unknown"
+        metrics.updates_total.inc(type=update_type)
+        with metrics.update_duration.time(type=update_type):
+            return await handler(event, data)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Inner middleware: runs only when a handler matched, so the latency is per handler
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            with tracing.span("handler", handler=name):
+                return await handler(event, data)
+        except Exception as e:
+            metrics.handler_errors.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.handler_duration.observe(time.perf_counter() - started, handler=name)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # Bot session middleware: every Bot API call, from handlers and background jobs alike
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        metrics.api_requests.inc(method=name)
+        started = time.perf_counter()
+        try:
+            with tracing.span("api", method=name):
+                return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.api_retry_after.inc(method=name)
+            metrics.api_errors.inc(method=name, error="TelegramRetryAfter")
+            raise
+        except Exception as e:
+            metrics.api_errors.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.api_duration.observe(time.perf_counter() - started, method=name)
+
+def setup_metrics(dp, bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    # Inner middlewares registered on the dispatcher apply to handlers of every included router
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
@@ -0,0 +1,102 @@
+import copy
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Collection, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.db.models import FsmState
+from app.db.utils import dialect_insert
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = (None, {})
+
+class SQLAlchemyStorage(BaseStorage):
+    # FSM storage on the app database. Nothing is kept in memory between reads: replicas
+    # behind a load balancer share no routing, so an admin's flow can continue on any of them
+    # and each read has to see the latest write.
+    #
+    # aiogram loads the state of every update's sender, but only a few users ever have one.
+    # With `state_holders` set, other users are never looked up at all.
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        state_ttl: timedelta = timedelta(days=1),
+        state_holders: Collection[int] | None = None,
+    ):
+        self.session_maker = session_maker
+        self.state_ttl = state_ttl
+        self.state_holders = frozenset(state_holders) if state_holders is not None else None
+
+    @staticmethod
+    def build_key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            key.thread_id,
+            getattr(key, "business_connection_id", None),
+            key.destiny,
+        ))
+
+    def _holds_state(self, key: StorageKey) -> bool:
+        return self.state_holders is None or key.user_id in self.state_holders
+
+    async def _load(self, key: StorageKey, db_key: str) -> tuple[Optional[str], Dict[str, Any]]:
+        if not self._holds_state(key):
+            return _EMPTY
+        async with self.session_maker() as session:
+            row = (await session.execute(
+                select(FsmState.state, FsmState.data).where(FsmState.key == db_key)
+            )).first()
+        return (row.state, row.data or {}) if row else _EMPTY
+
+    async def _save(self, key: StorageKey, db_key: str, state: Optional[str], data: Dict[str, Any]):
+        if not self._holds_state(key) and (state is not None or data):
+            logger.warning(f"FSM state written for user {key.user_id}, who is not a state holder; it won't be read back")
+        async with self.session_maker() as session:
+            if state is None and not data:
+                await session.execute(delete(FsmState).where(FsmState.key == db_key))
+            else:
+                now = datetime.utcnow()
+                stmt = dialect_insert(session, FsmState).values(key=db_key, state=state, data=data, updated_at=now)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[FsmState.key],
+                    set_={"state": state, "data": data, "updated_at": now}
+                )
+                await session.execute(stmt)
+            await session.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key = self.build_key(key)
+        new_state = state.state if isinstance(state, State) else state
+        _, data = await self._load(key, db_key)
+        await self._save(key, db_key, new_state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key, self.build_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        db_key = self.build_key(key)
+        state, _ = await self._load(key, db_key)
+        await self._save(key, db_key, state, copy.deepcopy(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key, self.build_key(key))
+        return copy.deepcopy(data)
+
+    async def cleanup(self) -> int:
+        # Drop states abandoned halfway through a flow
+        cutoff = datetime.utcnow() - self.state_ttl
+        async with self.session_maker() as session:
+            result = await session.execute(delete(FsmState).where(FsmState.updated_at < cutoff))
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Removed {result.rowcount} abandoned FSM states")
+        return result.rowcount
+
+    async def close(self) -> None:
+        pass
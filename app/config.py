@@ -1,6 +1,6 @@
 from pydantic_settings import BaseSettings
-from typing import List, Union
-from pydantic import field_validator
+from typing import List, Union, Literal
+from pydantic import field_validator, model_validator
 import json
 
 class Settings(BaseSettings):
@@ -38,6 +38,25 @@ class Settings(BaseSettings):
     # Or SQLite
     SQLITE_DB: str = "sqlite+aiosqlite:///./bot.db"
     USE_POSTGRES: bool = False
+    # Log the number of SQL statements per update at INFO (DEBUG otherwise)
+    LOG_QUERY_COUNTS: bool = False
+
+    # Engine profile: "tuned" applies the options below, "default" leaves SQLAlchemy/driver defaults
+    DB_PROFILE: Literal["default", "tuned"] = "tuned"
+    # SQLite (tuned): WAL lets readers run next to the single writer, busy_timeout makes
+    # writers wait for the lock instead of failing with "database is locked"
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE_KB: int = 20000
+    # Postgres (tuned)
+    PG_POOL_SIZE: int = 10
+    PG_MAX_OVERFLOW: int = 20
+    PG_POOL_RECYCLE: int = 1800
+    PG_STATEMENT_CACHE_SIZE: int = 500
+    PG_STATEMENT_TIMEOUT_MS: int = 30000
+    PG_IDLE_IN_TRANSACTION_TIMEOUT_MS: int = 60000
 
     # CHANNELS
     PUBLIC_CHANNEL_USERNAMES: str  # Comma separated list in env, parsed later or type List[str] if pydantic supports comma split automatically (it usually needs validator). Let's keep str and split.
@@ -47,9 +66,49 @@ class Settings(BaseSettings):
     PROVIDER_TOKEN: str           # From @BotFather
     CURRENCY: str = "UZS"
 
+    # EXPIRY
+    # Expirations fire on time from an in-process timer; this is only the safety net
+    EXPIRY_RECONCILE_MINUTES: int = 60
+
+    # BROADCAST
+    # Telegram allows ~30 messages/second per bot, stay a bit below it
+    BROADCAST_RATE: float = 25
+    BROADCAST_CONCURRENCY: int = 25
+    BROADCAST_BATCH_SIZE: int = 500
+
     # WEB SERVER (for keep-alive)
     PORT: int = 10000
 
+    # UPDATE DELIVERY
+    # "polling" (default, for local runs) or "webhook" (served on the web server above)
+    BOT_MODE: Literal["polling", "webhook"] = "polling"
+    WEBHOOK_BASE_URL: str | None = None   # public https URL, e.g. https://bot.example.com
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str | None = None
+    # Handler processes. With more than 1, app.main starts a supervisor: one intake process
+    # receives updates and shards them by user id to the workers (app/supervisor.py).
+    # Worker i serves its /metrics on PORT + 1 + i.
+    WORKERS: int = 1
+    WORKER_CONCURRENCY: int = 100
+    # With several workers an admin change only invalidates the caches of its own worker;
+    # the others reload the plan/video catalogs at least this often (seconds)
+    CATALOG_MAX_AGE: int = 60
+    # Custom Bot API server (a local telegram-bot-api, or benchmarks/fake_api.py for load tests)
+    TELEGRAM_API_URL: str | None = None
+
+    # DIAGNOSTICS
+    # Updates slower than this are logged with their span tree (handler, SQL, Bot API calls)
+    SLOW_UPDATE_MS: int = 1000
+    # cProfile a share of updates (0-100); can also be changed at runtime with /profile
+    PROFILE_SAMPLE_PERCENT: float = 0
+    PROFILE_DIR: str = "profiles"
+
+    @model_validator(mode="after")
+    def check_webhook(self):
+        if self.BOT_MODE == "webhook" and not self.WEBHOOK_BASE_URL:
+            raise ValueError("WEBHOOK_BASE_URL is required when BOT_MODE=webhook")
+        return self
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -1 +1 @@
-from .models import User, Plan, Subscription, Payment, Video, engine, async_session, init_db
+from .models import User, Plan, Subscription, Payment, Video, ChannelMember, BroadcastJob, FsmState, InviteLink, StatsRollup, engine, async_session, init_db
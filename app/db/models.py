@@ -1,8 +1,9 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 import logging
-from sqlalchemy import BigInteger, String, Integer, Boolean, DateTime, ForeignKey, MetaData, LargeBinary
+from sqlalchemy import BigInteger, String, Integer, Boolean, DateTime, ForeignKey, MetaData, LargeBinary, Index, JSON, event, false, func, text
 from datetime import datetime
+from pathlib import Path
 from app.config import settings
 
 class Base(DeclarativeBase):
@@ -15,10 +16,26 @@ class User(Base):
     username: Mapped[str | None] = mapped_column(String(255))
     full_name: Mapped[str | None] = mapped_column(String(255))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Denormalized from subscriptions so the access check is a PK fetch.
+    # Maintained by record_payment and the expiry sweep.
+    paid_until: Mapped[datetime | None] = mapped_column(DateTime)
+    is_lifetime: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+    paid_plan_id: Mapped[int | None] = mapped_column(Integer)
+    # Set when a broadcast gets "bot was blocked by the user"; cleared on /start
+    blocked_at: Mapped[datetime | None] = mapped_column(DateTime)
 
     subscriptions: Mapped[list["Subscription"]] = relationship(back_populates="user")
     payments: Mapped[list["Payment"]] = relationship(back_populates="user")
 
+    __table_args__ = (
+        # Admin user browser keyset pagination
+        Index("ix_users_created_at_id", "created_at", "id"),
+    )
+
+# Admin user browser prefix search (migration 0004 adds text_pattern_ops on Postgres)
+Index("ix_users_username_lower", func.lower(User.username))
+Index("ix_users_full_name_lower", func.lower(User.full_name))
+
 class Plan(Base):
     __tablename__ = "plans"
     
@@ -41,6 +58,17 @@ class Subscription(Base):
     user: Mapped["User"] = relationship(back_populates="subscriptions")
     plan: Mapped["Plan"] = relationship()
 
+    __table_args__ = (
+        # get_active_subscription
+        Index("ix_subscriptions_user_active_end", "user_id", "is_active", "end_date"),
+        # Expiry sweep: only active rows are ever scanned, keep the index small
+        Index(
+            "ix_subscriptions_active_end", "end_date",
+            postgresql_where=text("is_active = true"),
+            sqlite_where=text("is_active = 1"),
+        ),
+    )
+
 class Payment(Base):
     __tablename__ = "payments"
     
@@ -63,22 +91,141 @@ class Video(Base):
     order: Mapped[int] = mapped_column(Integer, default=0)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
 
+    __table_args__ = (
+        Index("ix_videos_active_order", "is_active", "order"),
+    )
+
+class ChannelMember(Base):
+    __tablename__ = "channel_members"
+
+    # Fed by chat_member updates for channels where the bot is an admin
+    # PK order (user_id, chat_id) serves the per-user gate lookup directly
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    status: Mapped[str] = mapped_column(String(20))
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # The admin's message that gets copied to every recipient
+    from_chat_id: Mapped[int] = mapped_column(BigInteger)
+    message_id: Mapped[int] = mapped_column(Integer)
+    # Live progress message
+    progress_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[int] = mapped_column(Integer)
+    status: Mapped[str] = mapped_column(String(20), default="pending") # pending, running, cancelling, done, cancelled
+    # Recipients are streamed by users.id; everything <= cursor has been handled
+    cursor: Mapped[int] = mapped_column(BigInteger, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime)
+
+class FsmState(Base):
+    __tablename__ = "fsm_states"
+
+    # StorageKey rendered as "bot:chat:user:thread:business:destiny"
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str | None] = mapped_column(String(255))
+    data: Mapped[dict] = mapped_column(JSON, default=dict)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class InviteLink(Base):
+    __tablename__ = "invite_links"
+
+    # One reusable join-request link to the private group per user
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    invite_link: Mapped[str] = mapped_column(String(255))
+    expire_date: Mapped[datetime] = mapped_column(DateTime)
+    creates_join_request: Mapped[bool] = mapped_column(Boolean, default=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class StatsRollup(Base):
+    __tablename__ = "stats_rollup"
+
+    # "total" or an ISO day ("2026-10-18"); maintained in the same transactions as the source rows
+    bucket: Mapped[str] = mapped_column(String(10), primary_key=True)
+    signups: Mapped[int] = mapped_column(Integer, default=0)
+    new_subs: Mapped[int] = mapped_column(Integer, default=0)
+    expirations: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(BigInteger, default=0) # In cents/tiyins
+
 # Database Connection
 if settings.USE_POSTGRES:
     DATABASE_URL = f"postgresql+asyncpg://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
 else:
     DATABASE_URL = settings.SQLITE_DB
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+def _sqlite_pragmas() -> list[str]:
+    return [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+        f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}",
+    ]
+
+def _postgres_options() -> dict:
+    return {
+        "pool_size": settings.PG_POOL_SIZE,
+        "max_overflow": settings.PG_MAX_OVERFLOW,
+        "pool_pre_ping": True,
+        "pool_recycle": settings.PG_POOL_RECYCLE,
+        "connect_args": {
+            # asyncpg prepared statements, cached per connection by SQLAlchemy's dialect
+            "prepared_statement_cache_size": settings.PG_STATEMENT_CACHE_SIZE,
+            "server_settings": {
+                "application_name": "subscription-bot",
+                "statement_timeout": str(settings.PG_STATEMENT_TIMEOUT_MS),
+                "idle_in_transaction_session_timeout": str(settings.PG_IDLE_IN_TRANSACTION_TIMEOUT_MS),
+                # Short OLTP queries only pay JIT compile time
+                "jit": "off",
+            },
+        },
+    }
+
+def build_engine(url: str, profile: str = "tuned") -> AsyncEngine:
+    if profile != "tuned":
+        return create_async_engine(url, echo=False)
+    if url.startswith("postgresql"):
+        return create_async_engine(url, echo=False, **_postgres_options())
+
+    new_engine = create_async_engine(url, echo=False)
+    if url.startswith("sqlite"):
+        pragmas = _sqlite_pragmas()
+
+        @event.listens_for(new_engine.sync_engine, "connect")
+        def _set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    return new_engine
+
+engine = build_engine(DATABASE_URL, settings.DB_PROFILE)
 async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / "migrations"
+
+def _run_migrations(connection):
+    from alembic import command
+    from alembic.config import Config
+    cfg = Config()
+    cfg.set_main_option("script_location", str(MIGRATIONS_DIR))
+    cfg.attributes["connection"] = connection
+    command.upgrade(cfg, "head")
+
 async def init_db():
     from sqlalchemy import select
     logger = logging.getLogger(__name__)
     logger.info("Initializing database...")
     async with engine.begin() as conn:
-        # Create all tables if they don't exist
-        await conn.run_sync(Base.metadata.create_all)
+        # Create or upgrade the schema. create_all can't alter existing tables, so this goes through alembic.
+        await conn.run_sync(_run_migrations)
     
     # Automatic Seeding
     async with async_session() as session:
@@ -0,0 +1,74 @@
+import asyncio
+import weakref
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from sqlalchemy import event, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+def dialect_insert(session: AsyncSession, table):
+    # INSERT construct with on_conflict_* support for the bound dialect
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+def extend_datetime(session: AsyncSession, column, now: datetime, days: int):
+    # SQL for max(column, now) + days, evaluated against the locked row; SQLite has no intervals
+    if session.bind.dialect.name == "postgresql":
+        return func.greatest(func.coalesce(column, now), now) + timedelta(days=days)
+    return func.datetime(func.max(func.coalesce(column, now), now), f"+{days} days")
+
+def after_commit(session: AsyncSession, callback):
+    # Run `callback()` once the session's current transaction commits; dropped on rollback.
+    # Used for in-process caches that must not see uncommitted data.
+    session.sync_session.info.setdefault("after_commit", []).append(callback)
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session):
+    session.info.pop("after_commit", None)
+
+# SQLite allows one writer at a time, and a writer that finds the file locked polls it
+# (busy_timeout) with sleeps of up to 100 ms. Under a burst of payments some waited seconds for
+# a lock that is held for a millisecond. Writers of this process queue on an asyncio lock
+# instead, held until their transaction ends. Other processes still go through busy_timeout.
+_sqlite_writers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+async def serialize_writes(session: AsyncSession):
+    # Call before the transaction's first write; a no-op on Postgres
+    if session.bind.dialect.name != "sqlite" or "write_lock" in session.sync_session.info:
+        return
+    connection = await session.connection()
+    raw = await connection.get_raw_connection()
+    if raw.driver_connection.in_transaction:
+        # Already written to (e.g. the membership index): it holds the file lock, and waiting
+        # here for a writer that waits on that file lock would deadlock
+        return
+    loop = asyncio.get_running_loop()
+    lock = _sqlite_writers.get(loop)
+    if lock is None:
+        lock = _sqlite_writers[loop] = asyncio.Lock()
+    await lock.acquire()
+    session.sync_session.info["write_lock"] = lock
+
+@event.listens_for(Session, "after_transaction_end")
+def _release_write_lock(session, transaction):
+    if transaction.parent is None:
+        lock = session.info.pop("write_lock", None)
+        if lock is not None:
+            lock.release()
+
+# Statements executed in the current update; set by DbSessionMiddleware
+query_counter: ContextVar[list[int] | None] = ContextVar("query_counter", default=None)
+
+def count_queries(engine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        counter = query_counter.get()
+        if counter is not None:
+            counter[0] += 1
@@ -2,19 +2,30 @@ import asyncio
 import logging
 import sys
 import os
-from datetime import timedelta
+import secrets
+from datetime import datetime, timedelta
 from aiohttp import web
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import BotCommand, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Project Imports
 from app.config import settings
-from app.db import init_db, async_session
-from app.bot.handlers import user, admin
-from app.bot.middlewares import ChannelMembershipMiddleware
-from app.services.subscriptions import disable_expired_subscriptions
+from app.db import init_db, async_session, engine
+from app.db.utils import count_queries
+from app.bot.handlers import user, admin, channels
+from app.bot.middlewares import ScopedFSMContextMiddleware, ChannelMembershipMiddleware, UserProfileMiddleware, DbSessionMiddleware, TracingMiddleware, setup_metrics
+from app.bot.storage import SQLAlchemyStorage
+from app.services.membership import discover_observed_channels
+from app.services.expiry import expiry_scheduler
+from app.services.broadcast import resume_jobs, JOB_POLL_INTERVAL
+from app.services.stats import ensure_stats
+from app.services.catalog import plan_catalog, video_catalog
+from app.services.users import profile_buffer
+from app.services import metrics, tracing
 
 # Logging configuration
 logging.basicConfig(
@@ -24,76 +35,183 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def check_expired_subscriptions(bot: Bot):
-    logger.info("Checking for expired subscriptions...")
-    async with async_session() as session:
-        expired_subs = await disable_expired_subscriptions(session)
-        for sub in expired_subs:
-            try:
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="💳 Obunani yangilash", callback_data="check_permissions")]
-                ])
-                await bot.send_message(
-                    sub.user_id, 
-                    "⏳ <b>Obunangiz tugadi.</b>\n\nPlatformadan foydalanishni davom ettirish uchun obunani yangilang.", 
-                    reply_markup=kb, 
-                    parse_mode="HTML"
-                )
-                # Kick/Unban logic to restrict access
-                await bot.ban_chat_member(chat_id=settings.PRIVATE_GROUP_ID, user_id=sub.user_id, until_date=timedelta(seconds=60))
-                await bot.unban_chat_member(chat_id=settings.PRIVATE_GROUP_ID, user_id=sub.user_id)
-                logger.info(f"Kicked user {sub.user_id} due to expiration.")
-            except Exception as e:
-                logger.error(f"Failed to kick user {sub.user_id}: {e}")
+@metrics.timed_job("expiry_reconcile")
+async def check_expired_subscriptions():
+    logger.info("Reconciling expired subscriptions...")
+    await expiry_scheduler.reconcile()
 
 async def handle_health_check(request):
-    return web.Response(text="Bot is running!")
+    return web.Response(text=f"Bot is running! (mode: {request.app['bot_mode']})")
+
+async def handle_metrics(request):
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
 
-async def start_web_server():
+def create_web_app() -> web.Application:
     app = web.Application()
+    app["bot_mode"] = settings.BOT_MODE
     app.router.add_get("/", handle_health_check)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+async def start_web_server(app: web.Application, port: int | None = None) -> web.AppRunner:
+    port = port or settings.PORT
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", settings.PORT)
+    site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
-    logger.info(f"Health check server started on port {settings.PORT}")
+    logger.info(f"Web server started on port {port} (mode: {settings.BOT_MODE})")
+    return runner
 
-async def main():
-    # 1. Initialize DB (Creates tables if not exists)
-    await init_db()
-    
-    bot = Bot(token=settings.BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+def setup_webhook(app: web.Application, dp: Dispatcher, bot: Bot) -> str:
+    # Telegram sends the secret in X-Telegram-Bot-Api-Secret-Token; the handler rejects other requests
+    secret = settings.WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set, using a random one (set it when running several replicas).")
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=settings.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return secret
+
+# Update types whose handlers use FSM state (the admin flows)
+FSM_UPDATE_TYPES = ("message", "callback_query")
+
+def create_dispatcher(bot: Bot) -> tuple[Dispatcher, SQLAlchemyStorage]:
+    # Middlewares and routers; shared with the benchmarks so they exercise the real pipeline
+    # FSM state lives in the database so admin flows survive restarts and work across workers
+    # Only admins have FSM flows, so nobody else's state is ever looked up
+    storage = SQLAlchemyStorage(async_session, state_holders=settings.ADMIN_IDS)
+    dp = Dispatcher(storage=storage, disable_fsm=True)
+    # Same place in the chain as aiogram's own FSM middleware; admin flows are the only FSM
+    # users, so payments and membership updates never wait on a state lookup
+    dp.fsm = ScopedFSMContextMiddleware(
+        storage=storage,
+        events_isolation=dp.fsm.events_isolation,
+        strategy=dp.fsm.strategy,
+        stateful_updates=FSM_UPDATE_TYPES,
+    )
+    dp.update.outer_middleware(dp.fsm)
+
+    # Span tree per update; slow ones are logged, a share can be profiled (see /profile)
+    dp.update.outer_middleware(TracingMiddleware(settings.SLOW_UPDATE_MS))
+    # Prometheus-style counters/histograms, served at /metrics
+    setup_metrics(dp, bot)
+    # One DB session per update, injected into handlers as `session`
+    dp.update.outer_middleware(DbSessionMiddleware(async_session, log_queries=settings.LOG_QUERY_COUNTS))
+    dp.update.outer_middleware(UserProfileMiddleware())
+    # Mandatory channel subscription for messages and buttons; after DbSessionMiddleware,
+    # it reads and seeds the local membership index through `session`
+    membership_middleware = ChannelMembershipMiddleware(settings.PUBLIC_CHANNEL_USERNAMES)
+    dp.message.outer_middleware(membership_middleware)
+    dp.callback_query.outer_middleware(membership_middleware)
 
     # Routers
     dp.include_router(admin.router)
     dp.include_router(user.router)
+    dp.include_router(channels.router)
+    return dp, storage
 
-    # 4. Start Health Check Web Server
-    await start_web_server()
+def create_bot() -> Bot:
+    api_session = None
+    if settings.TELEGRAM_API_URL:
+        api_session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
+    return Bot(token=settings.BOT_TOKEN, session=api_session)
 
-    # 5. Start Background Scheduler
+def instrument_engine():
+    # Engine-wide instrumentation: per-update query counts, metrics, trace spans
+    count_queries(engine)
+    metrics.instrument_engine(engine)
+    tracing.instrument_engine(engine)
+    tracing.profiler.percent = settings.PROFILE_SAMPLE_PERCENT
+    tracing.profiler.directory = settings.PROFILE_DIR
+
+async def start_background_jobs(bot: Bot, storage: SQLAlchemyStorage) -> AsyncIOScheduler:
+    # Each end_date fires on time from the in-process timer; the periodic job is the safety net
+    await expiry_scheduler.start(bot)
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_expired_subscriptions, 'interval', minutes=5, kwargs={'bot': bot})
+    scheduler.add_job(
+        check_expired_subscriptions, 'interval', minutes=settings.EXPIRY_RECONCILE_MINUTES,
+        max_instances=1, coalesce=True, next_run_time=datetime.now()
+    )
+    scheduler.add_job(metrics.timed_job("fsm_cleanup")(storage.cleanup), 'interval', hours=1, max_instances=1, coalesce=True)
+    if settings.WORKERS > 1:
+        # Only this worker runs broadcasts; pick up the ones created through other workers
+        scheduler.add_job(resume_jobs, 'interval', seconds=JOB_POLL_INTERVAL, args=[bot], max_instances=1, coalesce=True)
     scheduler.start()
 
-    # 6. Set Bot Commands
+    # Continue broadcasts interrupted by a restart
+    await resume_jobs(bot)
+    return scheduler
+
+async def set_commands(bot: Bot):
     await bot.set_my_commands([
         BotCommand(command="start", description="Boshlash"),
         BotCommand(command="help", description="Yordam"),
     ])
 
-    logger.info("Bot application fully initialized. Starting polling...")
+async def main():
+    # 1. Initialize DB (Creates tables if not exists)
+    await init_db()
+    async with async_session() as session:
+        await ensure_stats(session)
     
+    bot = create_bot()
+    instrument_engine()
+    dp, storage = create_dispatcher(bot)
+    # Snapshots are loaded before the first update, so pre_checkout never waits on the DB
+    for catalog in (plan_catalog, video_catalog):
+        await catalog.ensure_fresh()
+
+    # Profile changes (username/full_name) are written behind in batches
+    profile_buffer.start()
+
+    # 3. Channels where the bot is admin feed the local membership index via chat_member updates
+    try:
+        await discover_observed_channels(bot, settings.PUBLIC_CHANNEL_USERNAMES)
+    except Exception as e:
+        logger.error(f"Failed to discover observed channels: {e}")
+
+    # 4. Start Web Server (health check, and the update endpoint in webhook mode)
+    app = create_web_app()
+    webhook_secret = None
+    if settings.BOT_MODE == "webhook":
+        webhook_secret = setup_webhook(app, dp, bot)
+    runner = await start_web_server(app)
+
+    # 5. Start Background Scheduler
+    await start_background_jobs(bot, storage)
+
+    # 6. Set Bot Commands
+    await set_commands(bot)
+
+    # chat_member updates are only delivered when requested explicitly
+    allowed_updates = dp.resolve_used_update_types()
+
     try:
-        await dp.start_polling(bot)
+        if settings.BOT_MODE == "webhook":
+            webhook_url = settings.WEBHOOK_BASE_URL.rstrip("/") + settings.WEBHOOK_PATH
+            await bot.set_webhook(webhook_url, secret_token=webhook_secret, allowed_updates=allowed_updates)
+            logger.info(f"Bot application fully initialized. Receiving updates at {webhook_url}")
+            await asyncio.Event().wait()
+        else:
+            logger.info("Bot application fully initialized. Starting polling...")
+            # getUpdates is refused while a webhook is set
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=allowed_updates)
     except Exception as e:
-        logger.error(f"Critical error during polling: {e}")
+        logger.error(f"Critical error while receiving updates: {e}")
     finally:
+        tracing.profiler.dump()
+        await profile_buffer.stop()
+        await runner.cleanup()
         await bot.session.close()
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if settings.WORKERS > 1:
+            # Intake process + WORKERS handler processes, sharded by user id
+            from app.supervisor import run_supervisor
+            asyncio.run(run_supervisor())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped!")
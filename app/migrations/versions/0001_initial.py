@@ -0,0 +1,82 @@
+"""initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _has_table(name: str) -> bool:
+    # Databases created by the old init_db (create_all) already have these tables
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not _has_table("users"):
+        op.create_table(
+            "users",
+            sa.Column("id", sa.BigInteger(), autoincrement=False, primary_key=True),
+            sa.Column("username", sa.String(255), nullable=True),
+            sa.Column("full_name", sa.String(255), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=False),
+        )
+    if not _has_table("plans"):
+        op.create_table(
+            "plans",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("name", sa.String(100), nullable=False),
+            sa.Column("duration_days", sa.Integer(), nullable=True),
+            sa.Column("price", sa.Integer(), nullable=False),
+            sa.Column("is_active", sa.Boolean(), nullable=False),
+        )
+    if not _has_table("subscriptions"):
+        op.create_table(
+            "subscriptions",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.BigInteger(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("plan_id", sa.Integer(), sa.ForeignKey("plans.id"), nullable=False),
+            sa.Column("start_date", sa.DateTime(), nullable=False),
+            sa.Column("end_date", sa.DateTime(), nullable=True),
+            sa.Column("is_active", sa.Boolean(), nullable=False),
+        )
+    if not _has_table("payments"):
+        op.create_table(
+            "payments",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("user_id", sa.BigInteger(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("amount", sa.Integer(), nullable=False),
+            sa.Column("currency", sa.String(10), nullable=False),
+            sa.Column("provider", sa.String(100), nullable=False),
+            sa.Column("tg_charge_id", sa.String(255), nullable=False, unique=True),
+            sa.Column("created_at", sa.DateTime(), nullable=False),
+        )
+    if not _has_table("videos"):
+        op.create_table(
+            "videos",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("title", sa.String(255), nullable=False),
+            sa.Column("file_id", sa.String(255), nullable=False),
+            sa.Column("order", sa.Integer(), nullable=False),
+            sa.Column("is_active", sa.Boolean(), nullable=False),
+        )
+    if not _has_table("channel_members"):
+        op.create_table(
+            "channel_members",
+            sa.Column("user_id", sa.BigInteger(), autoincrement=False, primary_key=True),
+            sa.Column("chat_id", sa.BigInteger(), autoincrement=False, primary_key=True),
+            sa.Column("status", sa.String(20), nullable=False),
+            sa.Column("updated_at", sa.DateTime(), nullable=False),
+        )
+
+
+def downgrade():
+    for name in ("channel_members", "videos", "payments", "subscriptions", "plans", "users"):
+        op.drop_table(name)
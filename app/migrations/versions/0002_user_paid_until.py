@@ -0,0 +1,61 @@
+"""denormalized paid_until / is_lifetime on users
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:01
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.add_column(sa.Column("paid_until", sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column("is_lifetime", sa.Boolean(), nullable=False, server_default=sa.false()))
+        batch_op.add_column(sa.Column("paid_plan_id", sa.Integer(), nullable=True))
+
+    # Backfill from the existing subscriptions history
+    users = sa.table(
+        "users",
+        sa.column("id", sa.BigInteger()),
+        sa.column("paid_until", sa.DateTime()),
+        sa.column("is_lifetime", sa.Boolean()),
+        sa.column("paid_plan_id", sa.Integer()),
+    )
+    subs = sa.table(
+        "subscriptions",
+        sa.column("user_id", sa.BigInteger()),
+        sa.column("plan_id", sa.Integer()),
+        sa.column("end_date", sa.DateTime()),
+        sa.column("is_active", sa.Boolean()),
+    )
+    op.execute(
+        users.update().values(
+            paid_until=sa.select(sa.func.max(subs.c.end_date))
+                .where(subs.c.user_id == users.c.id)
+                .scalar_subquery(),
+            is_lifetime=sa.exists().where(
+                subs.c.user_id == users.c.id,
+                subs.c.is_active == sa.true(),
+                subs.c.end_date.is_(None),
+            ),
+            paid_plan_id=sa.select(subs.c.plan_id)
+                .where(subs.c.user_id == users.c.id)
+                .order_by(subs.c.end_date.is_(None).desc(), subs.c.end_date.desc())
+                .limit(1)
+                .scalar_subquery(),
+        )
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("paid_plan_id")
+        batch_op.drop_column("is_lifetime")
+        batch_op.drop_column("paid_until")
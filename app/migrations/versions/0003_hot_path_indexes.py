@@ -0,0 +1,35 @@
+"""indexes for the hot query paths
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:02
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_subscriptions_user_active_end", "subscriptions",
+        ["user_id", "is_active", "end_date"],
+    )
+    op.create_index(
+        "ix_subscriptions_active_end", "subscriptions", ["end_date"],
+        postgresql_where=sa.text("is_active = true"),
+        sqlite_where=sa.text("is_active = 1"),
+    )
+    op.create_index("ix_videos_active_order", "videos", ["is_active", "order"])
+    op.create_index("ix_users_created_at", "users", ["created_at"])
+
+
+def downgrade():
+    op.drop_index("ix_users_created_at", table_name="users")
+    op.drop_index("ix_videos_active_order", table_name="videos")
+    op.drop_index("ix_subscriptions_active_end", table_name="subscriptions")
+    op.drop_index("ix_subscriptions_user_active_end", table_name="subscriptions")
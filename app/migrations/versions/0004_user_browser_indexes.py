@@ -0,0 +1,30 @@
+"""keyset and prefix search indexes for the admin user browser
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:03
+
+"""
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index("ix_users_created_at", table_name="users")
+    op.create_index("ix_users_created_at_id", "users", ["created_at", "id"])
+
+    # LIKE 'prefix%' only uses a btree on Postgres with text_pattern_ops
+    opclass = " text_pattern_ops" if op.get_bind().dialect.name == "postgresql" else ""
+    op.execute(f"CREATE INDEX ix_users_username_lower ON users (lower(username){opclass})")
+    op.execute(f"CREATE INDEX ix_users_full_name_lower ON users (lower(full_name){opclass})")
+
+
+def downgrade():
+    op.drop_index("ix_users_full_name_lower", table_name="users")
+    op.drop_index("ix_users_username_lower", table_name="users")
+    op.drop_index("ix_users_created_at_id", table_name="users")
+    op.create_index("ix_users_created_at", "users", ["created_at"])
@@ -0,0 +1,42 @@
+"""persisted broadcast jobs and blocked users
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:04
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.add_column(sa.Column("blocked_at", sa.DateTime(), nullable=True))
+
+    op.create_table(
+        "broadcast_jobs",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("from_chat_id", sa.BigInteger(), nullable=False),
+        sa.Column("message_id", sa.Integer(), nullable=False),
+        sa.Column("progress_chat_id", sa.BigInteger(), nullable=False),
+        sa.Column("progress_message_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(20), nullable=False),
+        sa.Column("cursor", sa.BigInteger(), nullable=False),
+        sa.Column("total", sa.Integer(), nullable=False),
+        sa.Column("sent", sa.Integer(), nullable=False),
+        sa.Column("failed", sa.Integer(), nullable=False),
+        sa.Column("blocked", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_table("broadcast_jobs")
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("blocked_at")
@@ -0,0 +1,30 @@
+"""database-backed FSM storage
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:05
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "fsm_states",
+        sa.Column("key", sa.String(255), primary_key=True),
+        sa.Column("state", sa.String(255), nullable=True),
+        sa.Column("data", sa.JSON(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_fsm_states_updated_at", "fsm_states", ["updated_at"])
+
+
+def downgrade():
+    op.drop_index("ix_fsm_states_updated_at", table_name="fsm_states")
+    op.drop_table("fsm_states")
@@ -0,0 +1,29 @@
+"""per-user invite link registry
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 00:00:06
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "invite_links",
+        sa.Column("user_id", sa.BigInteger(), autoincrement=False, primary_key=True),
+        sa.Column("invite_link", sa.String(255), nullable=False),
+        sa.Column("expire_date", sa.DateTime(), nullable=False),
+        sa.Column("creates_join_request", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("invite_links")
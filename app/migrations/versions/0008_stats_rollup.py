@@ -0,0 +1,30 @@
+"""stats rollup for the admin panel
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 00:00:07
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled by app.services.stats.rebuild_stats on first start
+    op.create_table(
+        "stats_rollup",
+        sa.Column("bucket", sa.String(10), primary_key=True),
+        sa.Column("signups", sa.Integer(), nullable=False),
+        sa.Column("new_subs", sa.Integer(), nullable=False),
+        sa.Column("expirations", sa.Integer(), nullable=False),
+        sa.Column("revenue", sa.BigInteger(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("stats_rollup")
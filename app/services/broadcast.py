@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramAPIError
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.db import async_session
+from app.db.models import BroadcastJob, User
+from app.services.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Shared by every running job: the Telegram limit is per bot, not per job.
+# Per process, so with WORKERS > 1 only worker 0 sends in bulk (broadcasts and the
+# expiry jobs); the other workers set runs_jobs = False and leave new jobs to its poll.
+send_bucket = TokenBucket(settings.BROADCAST_RATE)
+runs_jobs = True
+JOB_POLL_INTERVAL = 2  # seconds; how often worker 0 picks up jobs created by other workers
+
+PROGRESS_INTERVAL = 2.5  # seconds between progress message edits and cancel checks
+MAX_RETRIES = 3
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+# Set by cancel_job in whichever process handled the button; the runner polls for it
+CANCELLING = "cancelling"
+
+_running: dict[int, asyncio.Task] = {}
+_cancelled: set[int] = set()
+
+async def create_job(session: AsyncSession, from_chat_id: int, message_id: int, progress_chat_id: int, progress_message_id: int) -> BroadcastJob:
+    total = await session.scalar(select(func.count(User.id)).where(User.blocked_at == None))
+    job = BroadcastJob(
+        from_chat_id=from_chat_id,
+        message_id=message_id,
+        progress_chat_id=progress_chat_id,
+        progress_message_id=progress_message_id,
+        status="pending",
+        cursor=0,
+        total=total or 0,
+        sent=0,
+        failed=0,
+        blocked=0,
+    )
+    session.add(job)
+    await session.commit()
+    return job
+
+def start_job(bot: Bot, job_id: int) -> asyncio.Task | None:
+    if not runs_jobs:
+        return None
+    task = asyncio.create_task(run_job(bot, job_id))
+    _running[job_id] = task
+    task.add_done_callback(lambda _: _running.pop(job_id, None))
+    return task
+
+async def cancel_job(session: AsyncSession, job_id: int):
+    # Immediate when the job runs in this process, otherwise within PROGRESS_INTERVAL
+    if job_id in _running:
+        _cancelled.add(job_id)
+    await session.execute(
+        update(BroadcastJob)
+        .where(BroadcastJob.id == job_id, BroadcastJob.status.in_(("pending", "running")))
+        .values(status=CANCELLING)
+    )
+
+async def _cancel_requested(job_id: int) -> bool:
+    async with async_session() as session:
+        return await session.scalar(select(BroadcastJob.status).where(BroadcastJob.id == job_id)) == CANCELLING
+
+async def resume_jobs(bot: Bot):
+    # New jobs from other workers, and jobs interrupted by a restart (from their persisted cursor)
+    async with async_session() as session:
+        job_ids = (await session.scalars(
+            select(BroadcastJob.id).where(BroadcastJob.status.in_(("pending", "running", CANCELLING)))
+        )).all()
+    for job_id in job_ids:
+        if job_id not in _running:
+            logger.info(f"Starting broadcast job {job_id}")
+            start_job(bot, job_id)
+
+async def _send(bot: Bot, job: BroadcastJob, user_id: int) -> str:
+    for _ in range(MAX_RETRIES):
+        await send_bucket.acquire()
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=job.from_chat_id, message_id=job.message_id)
+            return SENT
+        except TelegramRetryAfter as e:
+            # Flood control applies to the whole bot: hold every sender, then retry this user
+            logger.warning(f"Broadcast {job.id}: RetryAfter {e.retry_after}s")
+            send_bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                return BLOCKED
+            logger.info(f"Broadcast {job.id}: failed for {user_id}: {e}")
+            return FAILED
+        except TelegramAPIError as e:
+            logger.info(f"Broadcast {job.id}: failed for {user_id}: {e}")
+            return FAILED
+    return FAILED
+
+def _progress_text(job: BroadcastJob, started: float, done_at_start: int, finished: bool = False) -> str:
+    done = job.sent + job.failed + job.blocked
+    elapsed = max(time.monotonic() - started, 0.001)
+    rate = (done - done_at_start) / elapsed
+    remaining = max(job.total - done, 0)
+    if finished:
+        header = "📢 <b>Yuborildi!</b>" if job.status == "done" else "⛔ <b>To'xtatildi.</b>"
+    else:
+        header = "⏳ <b>Yuborilmoqda...</b>"
+    text = (
+        f"{header}\n\n"
+        f"📬 {done} / {job.total}\n"
+        f"✅ {job.sent}\n"
+        f"❌ {job.failed}\n"
+        f"🚫 {job.blocked} (botni bloklagan)\n"
+        f"⚡ {rate:.1f} msg/s"
+    )
+    if not finished and rate > 0:
+        eta = int(remaining / rate)
+        text += f"\n⏱ ~{eta // 60:02d}:{eta % 60:02d} qoldi"
+    return text
+
+def _progress_kb(job_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ To'xtatish", callback_data=f"broadcast_cancel:{job_id}")]
+    ])
+
+async def _update_progress(bot: Bot, job: BroadcastJob, started: float, done_at_start: int, finished: bool = False):
+    try:
+        await bot.edit_message_text(
+            _progress_text(job, started, done_at_start, finished),
+            chat_id=job.progress_chat_id,
+            message_id=job.progress_message_id,
+            reply_markup=None if finished else _progress_kb(job.id),
+            parse_mode="HTML",
+        )
+    except TelegramAPIError as e:
+        logger.debug(f"Broadcast {job.id}: progress update skipped: {e}")
+
+async def run_job(bot: Bot, job_id: int):
+    async with async_session() as session:
+        job = await session.get(BroadcastJob, job_id)
+        if not job or job.status in ("done", "cancelled"):
+            return
+        if job.status == CANCELLING:
+            # Cancelled before it started, or while this process was down
+            _cancelled.add(job_id)
+        else:
+            job.status = "running"
+            await session.commit()
+
+        semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+        started = time.monotonic()
+        done_at_start = job.sent + job.failed + job.blocked
+
+        async def send_one(user_id: int) -> str | None:
+            async with semaphore:
+                # A cancel takes effect mid-batch: queued sends are dropped, not rate-limited out
+                if job_id in _cancelled:
+                    return None
+                result = await _send(bot, job, user_id)
+            # Counted as they happen so the progress message is live; committed per batch
+            if result == SENT:
+                job.sent += 1
+            elif result == BLOCKED:
+                job.blocked += 1
+            else:
+                job.failed += 1
+            return result
+
+        async def report_progress():
+            # On a timer rather than per batch: a batch takes ~20s at the default rate
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                if await _cancel_requested(job_id):
+                    _cancelled.add(job_id)
+                await _update_progress(bot, job, started, done_at_start)
+
+        reporter = asyncio.create_task(report_progress())
+        try:
+            while job_id not in _cancelled:
+                # Stream recipients in PK order; the cursor makes the job resumable
+                user_ids = (await session.scalars(
+                    select(User.id)
+                    .where(User.id > job.cursor, User.blocked_at == None)
+                    .order_by(User.id)
+                    .limit(settings.BROADCAST_BATCH_SIZE)
+                )).all()
+                if not user_ids:
+                    break
+
+                results = await asyncio.gather(*(send_one(uid) for uid in user_ids))
+
+                blocked_ids = [uid for uid, res in zip(user_ids, results) if res == BLOCKED]
+                if blocked_ids:
+                    await session.execute(
+                        update(User).where(User.id.in_(blocked_ids)).values(blocked_at=datetime.utcnow()),
+                        execution_options={"synchronize_session": False}
+                    )
+                job.cursor = user_ids[-1]
+                await session.commit()
+        finally:
+            reporter.cancel()
+
+        job.status = "cancelled" if job_id in _cancelled else "done"
+        job.finished_at = datetime.utcnow()
+        await session.commit()
+        _cancelled.discard(job_id)
+
+    logger.info(f"Broadcast {job_id} {job.status}: sent={job.sent} failed={job.failed} blocked={job.blocked}")
+    await _update_progress(bot, job, started, done_at_start, finished=True)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select
+from app.db import async_session
+from app.db.models import Video, Plan
+from app.bot.keyboards import get_videos_keyboard, get_plans_keyboard
+
+logger = logging.getLogger(__name__)
+
+VIDEOS_PER_PAGE = 5
+
+class CatalogVideo(NamedTuple):
+    id: int
+    title: str
+    file_id: str
+
+class CatalogPlan(NamedTuple):
+    id: int
+    name: str
+    duration_days: int | None
+    price: int
+    is_active: bool
+
+class _Snapshot(ABC):
+    # In-memory copy of a small admin-managed table with its keyboards prebuilt.
+    # Admin mutations call invalidate(); the next reader rebuilds once.
+    def __init__(self):
+        self.version = 0
+        self._built_version = -1
+        self._lock = asyncio.Lock()
+        # Optional upper bound on staleness, for changes made by another process
+        self.max_age: float | None = None
+        self._built_at = 0.0
+        self._refresh: asyncio.Task | None = None
+
+    def invalidate(self):
+        self.version += 1
+
+    def _is_current(self) -> bool:
+        return self._built_version == self.version
+
+    def _is_fresh(self) -> bool:
+        if not self._is_current():
+            return False
+        return self.max_age is None or time.monotonic() - self._built_at < self.max_age
+
+    async def ensure_fresh(self, allow_stale: bool = False):
+        if self._is_fresh():
+            return
+        if allow_stale and self._is_current():
+            # Only aged out: latency-critical readers keep the current snapshot until the
+            # background rebuild swaps it. Explicit invalidations are still awaited.
+            if self._refresh is None or self._refresh.done():
+                self._refresh = asyncio.create_task(self._refresh_in_background())
+            return
+        async with self._lock:
+            if self._is_fresh():
+                return
+            # Aging out doesn't touch the version, so allow_stale readers never wait here
+            version = self.version
+            async with async_session() as session:
+                rows = (await session.execute(self._query())).all()
+            self._rebuild(rows, version)
+            self._built_at = time.monotonic()
+
+    async def _refresh_in_background(self):
+        try:
+            await self.ensure_fresh()
+        except Exception as e:
+            logger.error(f"Background refresh of {type(self).__name__} failed: {e}")
+
+    @abstractmethod
+    def _query(self):
+        # SELECT whose rows feed _rebuild
+        ...
+
+    @abstractmethod
+    def _rebuild(self, rows, version: int):
+        ...
+
+class VideoCatalog(_Snapshot):
+    def __init__(self, per_page: int = VIDEOS_PER_PAGE):
+        super().__init__()
+        self.per_page = per_page
+        self._videos: tuple[CatalogVideo, ...] = ()
+        self._by_id: dict[int, CatalogVideo] = {}
+        self._pages: tuple[InlineKeyboardMarkup, ...] = ()
+
+    @property
+    def total_pages(self) -> int:
+        return len(self._pages)
+
+    def _query(self):
+        return select(Video.id, Video.title, Video.file_id).where(Video.is_active == True).order_by(Video.order)
+
+    def _rebuild(self, rows, version: int):
+        videos = [CatalogVideo(*row) for row in rows]
+        total_pages = (len(videos) + self.per_page - 1) // self.per_page
+        pages = []
+        for page in range(1, total_pages + 1):
+            chunk = videos[(page-1)*self.per_page : page*self.per_page]
+            pages.append(get_videos_keyboard(chunk, page, total_pages))
+        self._videos = tuple(videos)
+        self._by_id = {v.id: v for v in videos}
+        self._pages = tuple(pages)
+        self._built_version = version
+        logger.info(f"Video catalog rebuilt: {len(videos)} videos, {total_pages} pages (v{version})")
+
+    def page(self, page: int) -> tuple[InlineKeyboardMarkup | None, int]:
+        # Returns the prebuilt keyboard and the page number actually used
+        if not self._pages:
+            return None, 0
+        page = min(max(page, 1), len(self._pages))
+        return self._pages[page - 1], page
+
+    def get(self, video_id: int) -> CatalogVideo | None:
+        return self._by_id.get(video_id)
+
+video_catalog = VideoCatalog()
+
+def plan_id_from_payload(payload: str) -> int | None:
+    # Invoices are sent with payload "plan_id:<id>"
+    prefix, _, plan_id = payload.partition(":")
+    if prefix != "plan_id" or not plan_id.isdigit():
+        return None
+    return int(plan_id)
+
+class PlanCatalog(_Snapshot):
+    # Every plan, inactive ones included: old invoices may still reference them
+    def __init__(self):
+        super().__init__()
+        self._by_id: dict[int, CatalogPlan] = {}
+        self._active: tuple[CatalogPlan, ...] = ()
+        self._keyboard: InlineKeyboardMarkup | None = None
+
+    def _query(self):
+        return select(Plan.id, Plan.name, Plan.duration_days, Plan.price, Plan.is_active).order_by(Plan.price, Plan.id)
+
+    def _rebuild(self, rows, version: int):
+        plans = [CatalogPlan(*row) for row in rows]
+        self._by_id = {p.id: p for p in plans}
+        self._active = tuple(p for p in plans if p.is_active)
+        self._keyboard = get_plans_keyboard(list(self._active))
+        self._built_version = version
+        logger.info(f"Plan catalog rebuilt: {len(self._active)}/{len(plans)} active plans (v{version})")
+
+    @property
+    def keyboard(self) -> InlineKeyboardMarkup | None:
+        return self._keyboard
+
+    @property
+    def plans(self) -> tuple[CatalogPlan, ...]:
+        return tuple(self._by_id.values())
+
+    @property
+    def active(self) -> tuple[CatalogPlan, ...]:
+        return self._active
+
+    def get(self, plan_id: int) -> CatalogPlan | None:
+        return self._by_id.get(plan_id)
+
+    def check_invoice(self, payload: str, total_amount: int, currency: str, expected_currency: str) -> str | None:
+        # Why an invoice can't be paid any more (or was tampered with), None if it can
+        plan_id = plan_id_from_payload(payload)
+        if plan_id is None:
+            return "payload"
+        plan = self._by_id.get(plan_id)
+        if plan is None:
+            return "unknown_plan"
+        if not plan.is_active:
+            return "inactive_plan"
+        if currency != expected_currency:
+            return "currency"
+        if total_amount != plan.price:
+            return "amount"
+        return None
+
+plan_catalog = PlanCatalog()
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import cache
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from app.config import settings
+from app.db import async_session
+from app.db.models import Subscription
+from sqlalchemy import select
+from app.services import metrics
+from app.services.broadcast import send_bucket
+from app.services.invites import revoke_invite_links
+from app.services.subscriptions import expire_subscriptions_batch, users_with_access
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_BATCH_SIZE = 200
+EXPIRY_CONCURRENCY = 10
+
+# One sweep at a time per process; the DB side is safe across processes anyway
+_sweep_lock = asyncio.Lock()
+
+@dataclass
+class SweepStats:
+    expired: int = 0
+    kicked: int = 0
+    skipped: int = 0
+    failures: int = 0
+    links_revoked: int = 0
+    duration: float = 0.0
+
+@cache
+def _renewal_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Obunani yangilash", callback_data="check_permissions")]
+    ])
+
+async def _call(method, *args, **kwargs):
+    # Bot API call under the shared bot-wide rate limit, retried once after RetryAfter
+    for attempt in range(2):
+        await send_bucket.acquire()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            send_bucket.pause(e.retry_after)
+            if attempt:
+                raise
+
+async def remove_user(bot: Bot, user_id: int) -> bool:
+    try:
+        await _call(
+            bot.send_message,
+            user_id,
+            "⏳ <b>Obunangiz tugadi.</b>\n\nPlatformadan foydalanishni davom ettirish uchun obunani yangilang.",
+            reply_markup=_renewal_kb(),
+            parse_mode="HTML"
+        )
+    except TelegramAPIError as e:
+        # The user may have blocked the bot; removing them from the group still matters
+        logger.info(f"Could not notify user {user_id} about expiration: {e}")
+    try:
+        # Kick/Unban logic to restrict access
+        await _call(bot.ban_chat_member, chat_id=settings.PRIVATE_GROUP_ID, user_id=user_id, until_date=timedelta(seconds=60))
+        await _call(bot.unban_chat_member, chat_id=settings.PRIVATE_GROUP_ID, user_id=user_id)
+        logger.info(f"Kicked user {user_id} due to expiration.")
+        return True
+    except TelegramAPIError as e:
+        logger.error(f"Failed to kick user {user_id}: {e}")
+        return False
+
+async def run_expiry_sweep(bot: Bot, wait: bool = False) -> SweepStats | None:
+    # wait=False: skip if a sweep is running (periodic runs); wait=True: queue behind it (deadlines)
+    if _sweep_lock.locked() and not wait:
+        logger.info("Expiry sweep already running, skipping this run.")
+        return None
+
+    async with _sweep_lock:
+        stats = SweepStats()
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+
+        async def process(user_id: int) -> bool:
+            async with semaphore:
+                return await remove_user(bot, user_id)
+
+        while True:
+            async with async_session() as session:
+                rows = await expire_subscriptions_batch(session, EXPIRY_BATCH_SIZE)
+                if not rows:
+                    break
+                user_ids = {user_id for _, user_id in rows}
+                still_entitled = await users_with_access(session, user_ids)
+
+            stats.expired += len(rows)
+            stats.skipped += len(still_entitled)
+            to_remove = user_ids - still_entitled
+            results = await asyncio.gather(*(process(uid) for uid in to_remove))
+            stats.kicked += sum(results)
+            stats.failures += results.count(False)
+            # Their join-request links must not let them back in
+            stats.links_revoked += await revoke_invite_links(bot, to_remove)
+
+            if len(rows) < EXPIRY_BATCH_SIZE:
+                break
+
+        stats.duration = time.monotonic() - started
+        metrics.job_duration.observe(stats.duration, job="expiry_sweep")
+        logger.info(
+            f"Expiry sweep: expired={stats.expired} kicked={stats.kicked} skipped={stats.skipped} "
+            f"failures={stats.failures} links_revoked={stats.links_revoked} duration={stats.duration:.2f}s"
+        )
+        return stats
+
+class ExpiryScheduler:
+    # Min-heap of upcoming end_dates; sleeps until the earliest one and sweeps right at it.
+    # Only the next `horizon` is kept in memory, the periodic reconcile() reloads the window.
+    def __init__(self, horizon: timedelta = timedelta(hours=6)):
+        self.horizon = horizon
+        self._heap: list[datetime] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._bot: Bot | None = None
+
+    def schedule(self, end_date: datetime | None):
+        # Only the process running the timer (worker 0 with WORKERS > 1) keeps a heap. Payments
+        # handled elsewhere are picked up from the DB by reconcile(); that is on time as long as
+        # the reconcile interval is shorter than the horizon, since a new end_date is at least
+        # a day away.
+        if self._task is None or end_date is None or end_date > datetime.utcnow() + self.horizon:
+            return
+        earliest = self._heap[0] if self._heap else None
+        heapq.heappush(self._heap, end_date)
+        if earliest is None or end_date < earliest:
+            self._wakeup.set()
+
+    async def load(self):
+        now = datetime.utcnow()
+        async with async_session() as session:
+            end_dates = (await session.scalars(
+                select(Subscription.end_date).where(
+                    Subscription.is_active == True,
+                    Subscription.end_date != None,
+                    Subscription.end_date < now + self.horizon
+                ).distinct()
+            )).all()
+        self._heap = list(end_dates)
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        logger.info(f"Expiry scheduler loaded {len(self._heap)} deadlines")
+
+    async def start(self, bot: Bot):
+        self._bot = bot
+        if timedelta(minutes=settings.EXPIRY_RECONCILE_MINUTES) >= self.horizon:
+            logger.warning(
+                f"EXPIRY_RECONCILE_MINUTES={settings.EXPIRY_RECONCILE_MINUTES} is not below the "
+                f"{self.horizon} horizon: subscriptions paid in other workers may expire late"
+            )
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def reconcile(self):
+        # Safety net for anything the timers missed (clock jumps, rows written elsewhere)
+        await self.load()
+        await run_expiry_sweep(self._bot, wait=True)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0] - datetime.utcnow()).total_seconds()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = datetime.utcnow()
+            while self._heap and self._heap[0] <= now:
+                heapq.heappop(self._heap)
+            try:
+                await run_expiry_sweep(self._bot, wait=True)
+            except Exception as e:
+                logger.error(f"Scheduled expiry sweep failed: {e}")
+
+expiry_scheduler = ExpiryScheduler()
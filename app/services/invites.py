@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.db import async_session
+from app.db.models import InviteLink
+from app.db.utils import dialect_insert, serialize_writes
+from app.services.broadcast import send_bucket
+
+logger = logging.getLogger(__name__)
+
+INVITE_LINK_TTL = timedelta(days=7)
+# Don't hand out a link that is about to expire
+INVITE_LINK_MIN_REMAINING = timedelta(hours=1)
+REVOKE_CONCURRENCY = 5
+
+def _usable(expire_date: datetime) -> bool:
+    return expire_date - INVITE_LINK_MIN_REMAINING > datetime.utcnow()
+
+async def get_invite_link(session: AsyncSession, bot: Bot, user_id: int) -> str:
+    # Always from the invite_links row, not from memory: the expiry sweep revokes links in
+    # another worker (or replica), and a revoked link must never be handed out again
+    row = await session.get(InviteLink, user_id)
+    if row and _usable(row.expire_date):
+        return row.invite_link
+
+    # Create Join Request Invite Link (Lock 2)
+    expire_date = datetime.utcnow() + INVITE_LINK_TTL
+    invite = await bot.create_chat_invite_link(
+        chat_id=settings.PRIVATE_GROUP_ID,
+        creates_join_request=True,
+        # Stored naive UTC, sent as a Unix timestamp: aiogram reads naive datetimes as local time
+        expire_date=int(expire_date.replace(tzinfo=timezone.utc).timestamp()),
+        name=f"Access Request {user_id}"
+    )
+    await serialize_writes(session)
+    stmt = dialect_insert(session, InviteLink).values(
+        user_id=user_id,
+        invite_link=invite.invite_link,
+        expire_date=expire_date,
+        creates_join_request=True,
+        created_at=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[InviteLink.user_id],
+        set_={"invite_link": invite.invite_link, "expire_date": expire_date}
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+    if row:
+        # The previous link expired or is about to; make sure it can't be used anymore
+        await _revoke(bot, row.invite_link)
+    return invite.invite_link
+
+async def _revoke(bot: Bot, invite_link: str) -> bool:
+    try:
+        await bot.revoke_chat_invite_link(chat_id=settings.PRIVATE_GROUP_ID, invite_link=invite_link)
+        return True
+    except TelegramAPIError as e:
+        # Already expired or revoked links are fine to forget
+        logger.info(f"Could not revoke invite link {invite_link}: {e}")
+        return False
+
+async def revoke_invite_links(bot: Bot, user_ids) -> int:
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+
+    async with async_session() as session:
+        rows = (await session.execute(
+            select(InviteLink.user_id, InviteLink.invite_link).where(InviteLink.user_id.in_(user_ids))
+        )).all()
+        if not rows:
+            return 0
+        await session.execute(delete(InviteLink).where(InviteLink.user_id.in_(user_ids)))
+        await session.commit()
+
+    semaphore = asyncio.Semaphore(REVOKE_CONCURRENCY)
+
+    async def revoke_one(invite_link: str) -> bool:
+        async with semaphore:
+            await send_bucket.acquire()
+            return await _revoke(bot, invite_link)
+
+    results = await asyncio.gather(*(revoke_one(link) for _, link in rows))
+    return sum(results)
@@ -0,0 +1,66 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.models import ChannelMember
+from app.db.utils import dialect_insert
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+# Configured channel (as in PUBLIC_CHANNEL_USERNAMES) -> chat_id, only for channels
+# where the bot is an admin and therefore receives chat_member updates.
+observed_channels: dict[str, int] = {}
+
+def normalize_channels(public_channel_usernames: str) -> list[str]:
+    channels = []
+    for ch in public_channel_usernames.split(','):
+        ch = ch.strip()
+        if not ch:
+            continue
+        # Ensure they start with @ or are IDs (ids usually don't need @, usernames do)
+        if not ch.startswith("-100") and not ch.startswith("@"):
+            ch = f"@{ch}"
+        channels.append(ch)
+    return channels
+
+async def discover_observed_channels(bot: Bot, public_channel_usernames: str) -> dict[str, int]:
+    me = await bot.me()
+    observed_channels.clear()
+    for channel in normalize_channels(public_channel_usernames):
+        try:
+            chat = await bot.get_chat(channel)
+            bot_member = await bot.get_chat_member(chat.id, me.id)
+        except TelegramAPIError as e:
+            logger.warning(f"Cannot observe {channel}, falling back to API checks: {e}")
+            continue
+        if bot_member.status in ("administrator", "creator"):
+            observed_channels[channel] = chat.id
+        else:
+            logger.info(f"Bot is not an admin in {channel}, membership will be polled.")
+    logger.info(f"Observed channels: {observed_channels}")
+    return observed_channels
+
+async def get_recorded_statuses(session: AsyncSession, user_id: int, chat_ids: list[int]) -> dict[int, str]:
+    if not chat_ids:
+        return {}
+    stmt = select(ChannelMember.chat_id, ChannelMember.status).where(
+        ChannelMember.user_id == user_id,
+        ChannelMember.chat_id.in_(chat_ids)
+    )
+    result = await session.execute(stmt)
+    return {chat_id: status for chat_id, status in result.all()}
+
+async def record_status(session: AsyncSession, chat_id: int, user_id: int, status: str):
+    now = datetime.utcnow()
+    stmt = dialect_insert(session, ChannelMember).values(
+        user_id=user_id, chat_id=chat_id, status=status, updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChannelMember.user_id, ChannelMember.chat_id],
+        set_={"status": status, "updated_at": now}
+    )
+    await session.execute(stmt)
@@ -0,0 +1,201 @@
+import time
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Minimal in-process metrics rendered in the Prometheus text format (served at /metrics).
+# No client library or push gateway: whatever scrapes the web port gets a snapshot.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: list["_Metric"] = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key in sorted(self._values):
+            lines.extend(self._render_value(key, self._values[key]))
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # [per-bucket counts..., sum, count]
+            entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+                break
+        entry[-2] += value
+        entry[-1] += 1
+
+    def time(self, **labels):
+        return _HistogramTimer(self, labels)
+
+    def _render_value(self, key, entry):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, entry):
+            cumulative += count
+            le = _labels(self.labelnames, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        le = _labels(self.labelnames, key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{le} {entry[-1]}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {entry[-2]}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {entry[-1]}")
+        return lines
+
+class CacheStats:
+    # Hit/miss counters that TTLCache keeps itself, read at scrape time
+    def __init__(self):
+        self._caches: dict[str, object] = {}
+        _registry.append(self)
+
+    def register(self, name: str, cache):
+        self._caches[name] = cache
+
+    def render(self) -> list[str]:
+        families = (
+            ("cache_hits_total", "counter", "Cache lookups answered from memory.", "hits"),
+            ("cache_misses_total", "counter", "Cache lookups that missed or found an expired entry.", "misses"),
+            ("cache_entries", "gauge", "Entries currently held.", "size"),
+        )
+        snapshot = {name: cache.stats() for name, cache in sorted(self._caches.items())}
+        lines = []
+        for metric, kind, documentation, field in families:
+            lines.extend((f"# HELP {metric} {documentation}", f"# TYPE {metric} {kind}"))
+            for name, stats in snapshot.items():
+                lines.append(f"{metric}{_labels(('cache',), (name,))} {stats[field]}")
+        return lines
+
+class _HistogramTimer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- Bot ---
+updates_total = Counter("bot_updates_total", "Updates received, by type.", ("type",))
+update_duration = Histogram("bot_update_duration_seconds", "Time to process one update end to end.", ("type",))
+handler_duration = Histogram("bot_handler_duration_seconds", "Handler latency.", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Handlers that raised.", ("handler", "error"))
+# Telegram waits only a few seconds for the pre-checkout answer; validation itself should be sub-millisecond
+pre_checkout_duration = Histogram(
+    "bot_pre_checkout_validation_seconds", "Pre-checkout validation time, by result (ok or rejection reason).", ("result",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+)
+
+# In-process caches (entitlements, channel membership, ...), registered by their owners
+caches = CacheStats()
+
+# --- Database ---
+db_queries = Counter("db_queries_total", "SQL statements executed.", ("operation",))
+db_query_duration = Histogram("db_query_duration_seconds", "SQL statement duration.", ("operation",))
+db_errors = Counter("db_errors_total", "SQL statements that failed.", ("operation",))
+
+# --- Telegram Bot API ---
+api_requests = Counter("telegram_api_requests_total", "Bot API calls.", ("method",))
+api_duration = Histogram("telegram_api_duration_seconds", "Bot API call duration.", ("method",))
+api_errors = Counter("telegram_api_errors_total", "Bot API calls that failed.", ("method", "error"))
+api_retry_after = Counter("telegram_api_retry_after_total", "Bot API calls rejected with RetryAfter (flood control).", ("method",))
+
+# --- Background jobs ---
+job_duration = Histogram("scheduler_job_duration_seconds", "Background job run time.", ("job",), buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0))
+job_errors = Counter("scheduler_job_errors_total", "Background job runs that raised.", ("job",))
+
+def timed_job(name: str):
+    # Decorator for scheduler jobs
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                job_errors.inc(job=name)
+                raise
+            finally:
+                job_duration.observe(time.perf_counter() - started, job=name)
+        return wrapper
+    return decorator
+
+def _operation(statement: str) -> str:
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OTHER"
+
+def instrument_engine(engine: AsyncEngine):
+    target = engine.sync_engine
+
+    @event.listens_for(target, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(target, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        operation = _operation(statement)
+        db_queries.inc(operation=operation)
+        db_query_duration.observe(time.perf_counter() - started, operation=operation)
+
+    @event.listens_for(target, "handle_error")
+    def _error(context):
+        stack = context.connection.info.get("metrics_started") if context.connection is not None else None
+        if stack:
+            stack.pop()
+        db_errors.inc(operation=_operation(context.statement or ""))
@@ -0,0 +1,101 @@
+import logging
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+from sqlalchemy import select, delete, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.models import StatsRollup, User, Subscription, Payment
+from app.db.utils import dialect_insert
+
+logger = logging.getLogger(__name__)
+
+TOTAL = "total"
+COUNTERS = ("signups", "new_subs", "expirations", "revenue")
+
+class StatsSnapshot(NamedTuple):
+    users: int
+    active_subs: int
+    expired_subs: int
+    revenue: int
+    # [(day, signups, new_subs, expirations, revenue)] oldest first, missing days included as zeros
+    daily: list[tuple[str, int, int, int, int]]
+
+def _bucket(day) -> str:
+    return day.isoformat()[:10] if hasattr(day, "isoformat") else str(day)[:10]
+
+async def bump_stats(session: AsyncSession, at: datetime | date | None = None, **deltas: int):
+    # Adds to the totals row and the day's bucket; call before the caller's commit
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    day = _bucket(at or datetime.utcnow())
+    rows = [
+        {**{c: 0 for c in COUNTERS}, **deltas, "bucket": bucket}
+        for bucket in (TOTAL, day)
+    ]
+    stmt = dialect_insert(session, StatsRollup).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[StatsRollup.bucket],
+        set_={c: getattr(StatsRollup, c) + getattr(stmt.excluded, c) for c in deltas}
+    )
+    await session.execute(stmt)
+
+async def get_stats(session: AsyncSession, days: int = 30) -> StatsSnapshot:
+    today = datetime.utcnow().date()
+    first_day = today - timedelta(days=days - 1)
+    # Totals plus at most `days` buckets, one PK range query
+    rows = (await session.scalars(
+        select(StatsRollup).where(or_(
+            StatsRollup.bucket == TOTAL,
+            StatsRollup.bucket.between(first_day.isoformat(), today.isoformat())
+        ))
+    )).all()
+    by_bucket = {row.bucket: row for row in rows}
+    total = by_bucket.get(TOTAL)
+
+    daily = []
+    for i in range(days):
+        day = (first_day + timedelta(days=i)).isoformat()
+        row = by_bucket.get(day)
+        daily.append((day, row.signups, row.new_subs, row.expirations, row.revenue) if row else (day, 0, 0, 0, 0))
+
+    if not total:
+        return StatsSnapshot(0, 0, 0, 0, daily)
+    return StatsSnapshot(
+        users=total.signups,
+        active_subs=total.new_subs - total.expirations,
+        expired_subs=total.expirations,
+        revenue=total.revenue,
+        daily=daily,
+    )
+
+async def rebuild_stats(session: AsyncSession):
+    # Recompute everything from users, subscriptions and payments
+    buckets: dict[str, dict[str, int]] = {}
+
+    def add(day, counter: str, value):
+        for bucket in (TOTAL, _bucket(day)):
+            buckets.setdefault(bucket, {c: 0 for c in COUNTERS})[counter] += int(value or 0)
+
+    sources = [
+        ("signups", select(func.date(User.created_at), func.count()).group_by(func.date(User.created_at))),
+        ("new_subs", select(func.date(Subscription.start_date), func.count()).group_by(func.date(Subscription.start_date))),
+        ("expirations", select(func.date(Subscription.end_date), func.count())
+            .where(Subscription.is_active == False)
+            .group_by(func.date(Subscription.end_date))),
+        ("revenue", select(func.date(Payment.created_at), func.sum(Payment.amount)).group_by(func.date(Payment.created_at))),
+    ]
+    for counter, stmt in sources:
+        for day, value in (await session.execute(stmt)).all():
+            if day is not None:
+                add(day, counter, value)
+
+    await session.execute(delete(StatsRollup))
+    if buckets:
+        session.add_all(StatsRollup(bucket=bucket, **values) for bucket, values in buckets.items())
+    await session.commit()
+    logger.info(f"Stats rollup rebuilt: {len(buckets)} buckets")
+
+async def ensure_stats(session: AsyncSession):
+    # First start after the migration: build the rollup from existing data
+    if await session.get(StatsRollup, TOTAL) is None:
+        await rebuild_stats(session)
@@ -1,62 +1,243 @@
-from sqlalchemy import select
+from sqlalchemy import BigInteger, select, update, insert, func, exists, literal
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.db.models import Subscription, Plan, User
-from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
+from app.db.utils import after_commit, dialect_insert, extend_datetime, serialize_writes
+from app.db.models import Subscription, User, Payment
+from app.services import metrics
+from app.services.cache import TTLCache
+from app.services.catalog import CatalogPlan
+from app.services.stats import bump_stats
+from app.services.users import register_user
+from collections import Counter
+from itertools import count
+from dataclasses import dataclass
+from datetime import datetime
+
+@dataclass(frozen=True, slots=True)
+class Entitlement:
+    user_id: int
+    plan_id: int | None
+    end_date: datetime | None  # None for lifetime
+
+# user_id -> Entitlement, or False when the user has no active subscription.
+# Entries never outlive the subscription's end_date.
+ENTITLEMENT_TTL = 300
+_entitlements = TTLCache(maxsize=50000, ttl=ENTITLEMENT_TTL)
+metrics.caches.register("entitlement", _entitlements)
+
+# user_id -> generation, bumped by every invalidation. A reader that fetched the row before a
+# payment committed must not cache its answer after the payment's invalidation has run.
+# Entries only need to outlive one fetch.
+_generations = TTLCache(maxsize=50000, ttl=60)
+_next_generation = count(1)
+
+def invalidate_entitlement(user_id: int):
+    _generations.set(user_id, next(_next_generation))
+    _entitlements.pop(user_id)
+
+def entitlement_cache_stats() -> dict:
+    return _entitlements.stats()
 
 async def get_active_subscription(session: AsyncSession, user_id: int) -> Subscription | None:
     stmt = select(Subscription).where(
         Subscription.user_id == user_id,
         Subscription.is_active == True,
         (Subscription.end_date > datetime.utcnow()) | (Subscription.end_date == None)
-    ).order_by(Subscription.end_date.desc())
+    ).options(joinedload(Subscription.plan)).order_by(Subscription.end_date.desc())
     
     result = await session.execute(stmt)
     return result.scalars().first()
 
-async def create_subscription(session: AsyncSession, user_id: int, plan_id: int) -> Subscription:
-    # 1. Get plan details
-    plan_stmt = select(Plan).where(Plan.id == plan_id)
-    plan_res = await session.execute(plan_stmt)
-    plan = plan_res.scalar_one_or_none()
-    
-    if not plan:
-        raise ValueError("Plan not found")
-
-    # 2. Calculate end date
-    start_date = datetime.utcnow()
-    end_date = None
-    if plan.duration_days:
-        end_date = start_date + timedelta(days=plan.duration_days)
-    
-    # 3. Create subscription
-    # Deactivate old active subs? Maybe not necessary if logic handles "latest valid".
-    # But usually good to close previous ones if they overlap or just extend?
-    # For now, let's just create a new one.
-    
-    new_sub = Subscription(
-        user_id=user_id,
-        plan_id=plan_id,
-        start_date=start_date,
-        end_date=end_date,
-        is_active=True
+async def get_entitlement(session: AsyncSession, user_id: int) -> Entitlement | None:
+    cached = _entitlements.get(user_id)
+    if cached is not None:
+        # Cached entries expire by TTL; still double-check in case the clock passed end_date
+        if cached is False:
+            return None
+        if cached.end_date is None or cached.end_date > datetime.utcnow():
+            return cached
+        invalidate_entitlement(user_id)
+
+    generation = _generations.get(user_id)
+    # Single PK fetch on users thanks to the denormalized paid_until / is_lifetime
+    user = await session.get(User, user_id)
+    now = datetime.utcnow()
+    cacheable = _generations.get(user_id) == generation
+    if not user or not (user.is_lifetime or (user.paid_until and user.paid_until > now)):
+        if cacheable:
+            _entitlements.set(user_id, False)
+        return None
+
+    end_date = None if user.is_lifetime else user.paid_until
+    entitlement = Entitlement(user_id=user_id, plan_id=user.paid_plan_id, end_date=end_date)
+    ttl = ENTITLEMENT_TTL
+    if end_date is not None:
+        ttl = min(ttl, (end_date - now).total_seconds())
+    if cacheable:
+        _entitlements.set(user_id, entitlement, ttl=ttl)
+    return entitlement
+
+@dataclass(frozen=True, slots=True)
+class PaymentResult:
+    subscription_id: int
+    end_date: datetime | None  # None for lifetime
+    extended: bool             # an active subscription was extended instead of a new row
+
+async def record_payment(
+    session: AsyncSession,
+    user_id: int,
+    plan: CatalogPlan,
+    amount: int,
+    currency: str,
+    provider: str,
+    charge_id: str,
+    username: str | None = None,
+    full_name: str | None = None,
+) -> PaymentResult | None:
+    # One transaction, keyed on Telegram's charge id: a redelivered (or concurrently
+    # duplicated) update finds its payment row already there and changes nothing.
+    # Returns None for duplicates. The caller commits.
+    # Usually four statements: payment, users, subscription, stats. On SQLite every one of them
+    # is spent holding the database's only write lock.
+    await serialize_writes(session)
+    now = datetime.utcnow()
+    payment_id = await session.scalar(_insert_payment(session, user_id, amount, currency, provider, charge_id, now))
+    created = False
+    if payment_id is None:
+        # A duplicate, or a missing users row (never sent /start, deleted by an admin).
+        # Telegram has already charged the user, so the row is created rather than failing.
+        created = await register_user(session, user_id, username, full_name)
+        payment_id = await session.scalar(_insert_payment(session, user_id, amount, currency, provider, charge_id, now))
+        if payment_id is None:
+            return None
+
+    # Extend from the current end while the user is still paid up, otherwise start now.
+    # The UPDATE locks the user row, so two different payments of one user serialize here.
+    # A payment means the bot isn't blocked any more.
+    #
+    # The current subscription comes back with the users row: its end is moved instead of
+    # stacking a parallel row, and a new subscriber goes straight to the INSERT
+    current = (
+        select(Subscription.id)
+        .where(
+            Subscription.user_id == user_id,
+            Subscription.is_active == True,
+            (Subscription.end_date > now) | (Subscription.end_date == None)
+        )
+        .order_by(Subscription.end_date.desc())
+        .limit(1)
     )
-    session.add(new_sub)
-    await session.commit()
-    await session.refresh(new_sub)
-    return new_sub
+    user_update = update(User).where(User.id == user_id)
+    if plan.duration_days is None:
+        user_update = user_update.values(paid_plan_id=plan.id, is_lifetime=True, blocked_at=None)
+    else:
+        # Lifetime users keep their lifetime subscription; the payment is still recorded
+        user_update = user_update.where(User.is_lifetime == False).values(
+            paid_plan_id=plan.id,
+            paid_until=extend_datetime(session, User.paid_until, now, plan.duration_days),
+            blocked_at=None,
+        )
+    user = (await session.execute(
+        user_update.returning(User.paid_until, User.is_lifetime, current.scalar_subquery().label("subscription_id")),
+        execution_options={"synchronize_session": False}
+    )).first()
 
-async def disable_expired_subscriptions(session: AsyncSession):
-    # Find active subs where end_date < now
-    stmt = select(Subscription).where(
-        Subscription.is_active == True,
-        Subscription.end_date != None,
-        Subscription.end_date < datetime.utcnow()
+    if user is None:
+        end_date = None
+        subscription_id = await session.scalar(current)
+    else:
+        end_date = None if user.is_lifetime else user.paid_until
+        subscription_id = user.subscription_id
+        if subscription_id is not None:
+            await session.execute(
+                update(Subscription).where(Subscription.id == subscription_id).values(plan_id=plan.id, end_date=end_date),
+                execution_options={"synchronize_session": False}
+            )
+    extended = subscription_id is not None
+    if not extended:
+        subscription_id = await session.scalar(
+            insert(Subscription)
+            .values(user_id=user_id, plan_id=plan.id, start_date=now, end_date=end_date, is_active=True)
+            .returning(Subscription.id)
+        )
+    await bump_stats(session, at=now, revenue=amount, new_subs=0 if extended else 1, signups=1 if created else 0)
+
+    from app.services.expiry import expiry_scheduler
+    after_commit(session, lambda: invalidate_entitlement(user_id))
+    after_commit(session, lambda: expiry_scheduler.schedule(end_date))
+    return PaymentResult(subscription_id=subscription_id, end_date=end_date, extended=extended)
+
+def _insert_payment(session: AsyncSession, user_id: int, amount: int, currency: str, provider: str, charge_id: str, now: datetime):
+    # INSERT ... SELECT FROM users: inserts nothing when the users row is missing, instead of
+    # failing on the foreign key. ON CONFLICT makes a known charge id a no-op as well.
+    values = select(
+        literal(user_id, BigInteger), literal(amount), literal(currency), literal(provider), literal(charge_id), literal(now)
+    ).where(User.id == user_id)
+    return (
+        dialect_insert(session, Payment)
+        .from_select(["user_id", "amount", "currency", "provider", "tg_charge_id", "created_at"], values)
+        .on_conflict_do_nothing(index_elements=[Payment.tg_charge_id])
+        .returning(Payment.id)
     )
-    result = await session.execute(stmt)
-    expired_subs = result.scalars().all()
-    
-    for sub in expired_subs:
-        sub.is_active = False
-    
+
+async def expire_subscriptions_batch(session: AsyncSession, limit: int = 200) -> list[tuple[int, int]]:
+    # Deactivate up to `limit` expired subscriptions in one UPDATE ... RETURNING.
+    # SKIP LOCKED (Postgres) lets concurrent sweepers take disjoint chunks; rows already
+    # deactivated are never returned again, so re-running is harmless.
+    due = (
+        select(Subscription.id)
+        .where(
+            Subscription.is_active == True,
+            Subscription.end_date != None,
+            Subscription.end_date < datetime.utcnow()
+        )
+        .order_by(Subscription.end_date)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(Subscription)
+        .where(Subscription.id.in_(due.scalar_subquery()), Subscription.is_active == True)
+        .values(is_active=False)
+        .returning(Subscription.id, Subscription.user_id, Subscription.end_date)
+    )
+    rows = (await session.execute(stmt, execution_options={"synchronize_session": False})).all()
+
+    user_ids = {row.user_id for row in rows}
+    await sync_paid_until(session, user_ids)
+    # Bucketed by the day each subscription ended, like rebuild_stats, not the day of the sweep
+    per_day = Counter(row.end_date.date() for row in rows)
+    for day, count in per_day.items():
+        await bump_stats(session, at=day, expirations=count)
     await session.commit()
-    return expired_subs
+    for user_id in user_ids:
+        invalidate_entitlement(user_id)
+    return [(row.id, row.user_id) for row in rows]
+
+async def users_with_access(session: AsyncSession, user_ids) -> set[int]:
+    # Users among `user_ids` that are still entitled, e.g. through another stacked subscription
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    stmt = select(User.id).where(
+        User.id.in_(user_ids),
+        (User.is_lifetime == True) | (User.paid_until > datetime.utcnow())
+    )
+    return set((await session.scalars(stmt)).all())
+
+async def sync_paid_until(session: AsyncSession, user_ids):
+    # Recompute the denormalized columns on users from their subscriptions history
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    stmt = update(User).where(User.id.in_(user_ids)).values(
+        paid_until=select(func.max(Subscription.end_date))
+            .where(Subscription.user_id == User.id)
+            .scalar_subquery(),
+        is_lifetime=exists().where(
+            Subscription.user_id == User.id,
+            Subscription.is_active == True,
+            Subscription.end_date == None
+        ),
+    )
+    await session.execute(stmt, execution_options={"synchronize_session": False})
@@ -0,0 +1,190 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+MAX_SPANS = 500  # per update; a runaway loop must not grow the trace forever
+SQL_PREVIEW = 200
+
+class Span:
+    __slots__ = ("name", "attrs", "started", "duration", "children")
+
+    def __init__(self, name: str, attrs: dict | None = None):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration: float | None = None
+        self.children: list[Span] = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self, origin: float) -> dict:
+        data = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 2),
+            "ms": round((self.duration or 0) * 1000, 2),
+        }
+        if self.attrs:
+            data.update(self.attrs)
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+class Trace:
+    # Span tree of one update. The open parent lives in a context variable, so spans
+    # started from tasks spawned by the handler (asyncio.gather) land under the right parent.
+    def __init__(self, name: str, attrs: dict):
+        self.root = Span(name, attrs)
+        self.count = 1
+        self.dropped = 0
+
+    def add(self, parent: Span, name: str, attrs: dict | None = None) -> Span | None:
+        if self.count >= MAX_SPANS:
+            self.dropped += 1
+            return None
+        child = Span(name, attrs)
+        parent.children.append(child)
+        self.count += 1
+        return child
+
+    def to_dict(self) -> dict:
+        data = self.root.to_dict(self.root.started)
+        if self.dropped:
+            data["dropped_spans"] = self.dropped
+        return data
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+def start_span(name: str, attrs: dict | None = None) -> Span | None:
+    # Leaf span under the open parent; the caller finishes it
+    trace = current_trace.get()
+    if trace is None:
+        return None
+    return trace.add(current_span.get() or trace.root, name, attrs)
+
+@contextmanager
+def span(name: str, **attrs):
+    opened = start_span(name, attrs or None)
+    if opened is None:
+        yield None
+        return
+    token = current_span.set(opened)
+    try:
+        yield opened
+    finally:
+        current_span.reset(token)
+        opened.finish()
+
+@contextmanager
+def trace_update(name: str, slow_threshold: float, **attrs):
+    trace = Trace(name, attrs)
+    trace_token = current_trace.set(trace)
+    span_token = current_span.set(trace.root)
+    try:
+        yield trace
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+        trace.root.finish()
+        if trace.root.duration >= slow_threshold:
+            # One JSON document per line so it can be grepped and loaded as is
+            logger.warning(f"slow_update {json.dumps(trace.to_dict(), ensure_ascii=False, default=str)}")
+
+def instrument_engine(engine: AsyncEngine):
+    # SQL statements become child spans of whatever is open in the current update
+    target = engine.sync_engine
+
+    @event.listens_for(target, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        opened = start_span("sql", {"statement": " ".join(statement.split())[:SQL_PREVIEW]})
+        conn.info.setdefault("trace_spans", []).append(opened)
+
+    @event.listens_for(target, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        opened = conn.info["trace_spans"].pop()
+        if opened is not None:
+            opened.finish()
+
+    @event.listens_for(target, "handle_error")
+    def _error(context):
+        stack = context.connection.info.get("trace_spans") if context.connection is not None else None
+        if stack:
+            opened = stack.pop()
+            if opened is not None:
+                opened.attrs["error"] = type(context.original_exception).__name__
+                opened.finish()
+
+class SamplingProfiler:
+    # cProfile over a random share of updates. The interpreter allows one active profiler,
+    # so a sampled update is skipped while another one is being profiled; whatever else the
+    # event loop runs in that window (other updates, jobs) lands in the profile too.
+    def __init__(self, percent: float = 0.0, directory: str = "profiles", dump_every: int = 100):
+        self.percent = percent
+        self.directory = directory
+        self.dump_every = dump_every
+        self.samples = 0
+        self._active = False
+        self._stats: pstats.Stats | None = None
+        self._pending = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.percent > 0
+
+    def set_percent(self, percent: float) -> str | None:
+        # Returns the dump path when profiling gets switched off with samples pending
+        self.percent = min(max(percent, 0.0), 100.0)
+        if not self.enabled:
+            return self.dump()
+        return None
+
+    @contextmanager
+    def maybe_profile(self):
+        if self._active or not self.enabled or random.random() * 100 >= self.percent:
+            yield
+            return
+        profiler = cProfile.Profile()
+        self._active = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._active = False
+            self._add(profiler)
+
+    def _add(self, profiler: cProfile.Profile):
+        if self._stats is None:
+            self._stats = pstats.Stats(profiler)
+        else:
+            self._stats.add(profiler)
+        self.samples += 1
+        self._pending += 1
+        if self._pending >= self.dump_every:
+            self.dump()
+
+    def dump(self) -> str | None:
+        # Load with `python -m pstats <file>` or snakeviz
+        if self._stats is None or not self._pending:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{os.getpid()}-{datetime.utcnow():%Y%m%d-%H%M%S}.pstats")
+        self._stats.dump_stats(path)
+        logger.info(f"Profile of {self._pending} sampled updates written to {path}")
+        self._stats = None
+        self._pending = 0
+        return path
+
+profiler = SamplingProfiler()
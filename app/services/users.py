@@ -0,0 +1,170 @@
+from sqlalchemy import select, update, bindparam, or_, and_, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import async_session
+from app.db.models import User
+from app.db.utils import dialect_insert
+from app.services.cache import TTLCache
+from datetime import datetime
+from typing import NamedTuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+async def register_user(session: AsyncSession, user_id: int, username: str | None, full_name: str | None) -> bool:
+    # Single-statement upsert; True when the user was created by this call.
+    # /start from a user the broadcast marked as blocked means they unblocked the bot:
+    # the conflict branch clears blocked_at, and only touches rows where it is set.
+    now = datetime.utcnow()
+    stmt = dialect_insert(session, User).values(
+        id=user_id,
+        username=username,
+        full_name=full_name,
+        created_at=now,
+        is_lifetime=False,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={"blocked_at": None},
+        where=User.blocked_at != None,
+    ).returning(User.created_at)
+    row = (await session.execute(stmt)).first()
+    created = row is not None and row.created_at == now
+    if created:
+        profile_buffer.remember(user_id, username, full_name)
+    return created
+
+class ProfileBuffer:
+    # Write-behind buffer for username/full_name changes seen on any update.
+    # Changes are coalesced per user and flushed as one bulk UPDATE every `interval` seconds.
+    # Senders without a users row (never sent /start) are simply not matched.
+    def __init__(self, interval: float = 5, known_size: int = 100000):
+        self.interval = interval
+        self._known = TTLCache(maxsize=known_size, ttl=3600)
+        self._pending: dict[int, tuple[str | None, str | None]] = {}
+        self._task: asyncio.Task | None = None
+
+    def remember(self, user_id: int, username: str | None, full_name: str | None):
+        self._known.set(user_id, (username, full_name))
+
+    def observe(self, user_id: int, username: str | None, full_name: str | None):
+        profile = (username, full_name)
+        if self._known.get(user_id) == profile:
+            return
+        self._pending[user_id] = profile
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [
+            {"b_id": user_id, "username": username, "full_name": full_name}
+            for user_id, (username, full_name) in pending.items()
+        ]
+        try:
+            async with async_session() as session:
+                # Core executemany: unlike the ORM bulk UPDATE by primary key, it doesn't
+                # require every id to match a row
+                users = User.__table__
+                await session.execute(update(users).where(users.c.id == bindparam("b_id")), rows)
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Profile flush failed, will retry: {e}")
+            for user_id, profile in pending.items():
+                self._pending.setdefault(user_id, profile)
+            return 0
+        for user_id, profile in pending.items():
+            self._known.set(user_id, profile)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+profile_buffer = ProfileBuffer()
+
+USER_FILTERS = {
+    "a": "Hammasi",
+    "c": "Faol",
+    "e": "Tugagan",
+    "n": "To'lamagan",
+}
+
+CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+class UserRow(NamedTuple):
+    id: int
+    username: str | None
+    full_name: str | None
+    created_at: datetime
+    paid_until: datetime | None
+    is_lifetime: bool
+
+def encode_cursor(row: UserRow) -> str:
+    return f"{row.created_at.strftime(CURSOR_FORMAT)}_{row.id}"
+
+def decode_cursor(cursor: str) -> tuple[datetime, int] | None:
+    if not cursor:
+        return None
+    created, user_id = cursor.split("_")
+    return datetime.strptime(created, CURSOR_FORMAT), int(user_id)
+
+def _prefix_match(dialect: str, column, prefix: str):
+    expr = func.lower(column)
+    if dialect == "postgresql":
+        # Served by the lower(...) text_pattern_ops index
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return expr.like(f"{escaped}%", escape="\\")
+    # SQLite doesn't apply the LIKE optimization to expression indexes, a range does the same job
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(expr >= prefix, expr < upper)
+
+async def browse_users(
+    session: AsyncSession,
+    user_filter: str = "a",
+    search: str | None = None,
+    cursor: str | None = None,
+    limit: int = 15,
+) -> tuple[list[UserRow], str | None]:
+    # One bounded keyset query per page: (created_at, id) descending, no OFFSET
+    stmt = select(
+        User.id, User.username, User.full_name, User.created_at, User.paid_until, User.is_lifetime
+    )
+
+    now = datetime.utcnow()
+    if user_filter == "c":
+        stmt = stmt.where(or_(User.is_lifetime == True, User.paid_until > now))
+    elif user_filter == "e":
+        stmt = stmt.where(User.is_lifetime == False, User.paid_until <= now)
+    elif user_filter == "n":
+        stmt = stmt.where(User.is_lifetime == False, User.paid_until == None)
+
+    search = (search or "").strip().lstrip("@").lower()
+    if search:
+        dialect = session.bind.dialect.name
+        stmt = stmt.where(or_(
+            _prefix_match(dialect, User.username, search),
+            _prefix_match(dialect, User.full_name, search),
+        ))
+
+    position = decode_cursor(cursor)
+    if position:
+        stmt = stmt.where(tuple_(User.created_at, User.id) < tuple_(*position))
+
+    stmt = stmt.order_by(User.created_at.desc(), User.id.desc()).limit(limit + 1)
+    rows = [UserRow(*row) for row in (await session.execute(stmt)).all()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
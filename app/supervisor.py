@@ -0,0 +1,254 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import secrets
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Supervisor mode (WORKERS > 1): this process only receives updates (polling or webhook)
+# and forwards the raw JSON to worker processes. Each update goes to worker
+# `user_id % WORKERS`, so one user's updates always land on the same worker, which
+# handles them strictly in order. Parsing, handlers and DB work happen in the workers.
+
+QUEUE_BATCHES = 1000  # per worker; intake waits when a worker falls this far behind
+POLL_TIMEOUT = 30
+POLL_MAX_BACKOFF = 30
+
+def update_shard_key(update: dict) -> int | None:
+    # The sender for almost every update type; the chat for channel posts and the like
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+# --- Worker side ---
+
+class OrderedFeeder:
+    # Concurrent across users, sequential per user: each update waits for the previous
+    # update of the same user before it is fed to the dispatcher.
+    def __init__(self, dp, bot, concurrency: int):
+        self.dp = dp
+        self.bot = bot
+        self._tails: dict[int | None, asyncio.Task] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def submit(self, key: int | None, update):
+        await self._slots.acquire()
+        previous = self._tails.get(key)
+        task = asyncio.create_task(self._run(previous, update))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+
+    def _done(self, key, task: asyncio.Task):
+        self._slots.release()
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, previous: asyncio.Task | None, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logger.exception(f"Update {update.update_id} failed: {e}")
+
+    async def drain(self):
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+async def _worker(index: int, queue: multiprocessing.Queue):
+    from aiogram.types import Update
+    from app.main import (
+        create_bot, create_dispatcher, create_web_app, instrument_engine, start_background_jobs, start_web_server,
+    )
+    from app.services import broadcast
+    from app.services.catalog import plan_catalog, video_catalog
+    from app.services.membership import discover_observed_channels
+    from app.services.tracing import profiler
+    from app.services.users import profile_buffer
+
+    bot = create_bot()
+    instrument_engine()
+    dp, storage = create_dispatcher(bot)
+    profile_buffer.start()
+    for catalog in (plan_catalog, video_catalog):
+        catalog.max_age = settings.CATALOG_MAX_AGE
+        await catalog.ensure_fresh()
+    # The send rate limit is per process: bulk sending (broadcasts, expiry kicks) stays in worker 0
+    broadcast.runs_jobs = index == 0
+    try:
+        await discover_observed_channels(bot, settings.PUBLIC_CHANNEL_USERNAMES)
+    except Exception as e:
+        logger.error(f"Worker {index}: failed to discover observed channels: {e}")
+
+    runner = await start_web_server(create_web_app(), settings.PORT + 1 + index)
+    # Expiry timers, periodic jobs and broadcast resumption run once, in worker 0
+    scheduler = await start_background_jobs(bot, storage) if index == 0 else None
+
+    feeder = OrderedFeeder(dp, bot, settings.WORKER_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    logger.info(f"Worker {index} ready")
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, queue.get)
+            if batch is None:
+                break
+            for key, raw in batch:
+                await feeder.submit(key, Update.model_validate(json.loads(raw), context={"bot": bot}))
+        await feeder.drain()
+    finally:
+        if scheduler:
+            scheduler.shutdown(wait=False)
+        profiler.dump()
+        await profile_buffer.stop()
+        await runner.cleanup()
+        await bot.session.close()
+        logger.info(f"Worker {index} stopped")
+
+def worker_main(index: int, queue: multiprocessing.Queue):
+    # Entry point of a spawned worker process
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - worker{index} - %(name)s - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+# --- Intake side ---
+
+class Supervisor:
+    def __init__(self, workers: int):
+        # spawn: workers build their own engine, loop and bot instead of inheriting ours
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queues = [self.ctx.Queue(QUEUE_BATCHES) for _ in range(workers)]
+        self.processes: list = [None] * workers
+
+    def start_worker(self, index: int):
+        process = self.ctx.Process(target=worker_main, args=(index, self.queues[index]), name=f"bot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def check_workers(self):
+        # A crashed worker is restarted on the same queue; updates it had taken are lost
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                self.start_worker(index)
+
+    async def dispatch(self, updates: list[dict]):
+        batches: list[list] = [[] for _ in self.queues]
+        for update in updates:
+            key = update_shard_key(update)
+            batches[(key or 0) % len(self.queues)].append((key, json.dumps(update)))
+        loop = asyncio.get_running_loop()
+        for queue, batch in zip(self.queues, batches):
+            if batch:
+                # Blocks only when the worker is QUEUE_BATCHES behind
+                await loop.run_in_executor(None, queue.put, batch)
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+async def _poll(supervisor: Supervisor, api_url: str, allowed_updates: list[str]):
+    offset = 0
+    backoff = 1
+    async with ClientSession(timeout=ClientTimeout(total=POLL_TIMEOUT + 10)) as http:
+        while True:
+            supervisor.check_workers()
+            try:
+                async with http.post(api_url, json={
+                    "offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates,
+                }) as response:
+                    payload = await response.json(content_type=None)
+            # Dropped connections, truncated bodies and non-JSON pages (a 502 from a proxy)
+            # must not take the intake, and with it every worker, down
+            except (asyncio.TimeoutError, ClientError, ValueError) as e:
+                logger.warning(f"getUpdates failed: {e!r}, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+                continue
+            if not isinstance(payload, dict):
+                payload = {"description": f"unexpected response {payload!r:.200}"}
+            if not payload.get("ok"):
+                retry_after = (payload.get("parameters") or {}).get("retry_after", backoff)
+                logger.warning(f"getUpdates error: {payload.get('description')}")
+                await asyncio.sleep(retry_after)
+                backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+                continue
+            backoff = 1
+            updates = payload["result"]
+            if updates:
+                await supervisor.dispatch(updates)
+                offset = updates[-1]["update_id"] + 1
+
+def _intake_app(supervisor: Supervisor, secret: str | None) -> web.Application:
+    # Health check, plus the webhook endpoint when a secret is given
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        await supervisor.dispatch([await request.json()])
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        supervisor.check_workers()
+        return web.Response(text=f"Bot is running! (mode: {settings.BOT_MODE}, workers: {len(supervisor.processes)})")
+
+    app = web.Application()
+    app.router.add_get("/", health)
+    if secret:
+        app.router.add_post(settings.WEBHOOK_PATH, handle)
+    return app
+
+async def run_supervisor():
+    from app.db import init_db, async_session
+    from app.main import create_bot, create_dispatcher, set_commands, start_web_server
+    from app.services.stats import ensure_stats
+
+    # Schema and seed data once, before any worker touches the database
+    await init_db()
+    async with async_session() as session:
+        await ensure_stats(session)
+
+    bot = create_bot()
+    # Only to learn which update types the routers use
+    allowed_updates = create_dispatcher(bot)[0].resolve_used_update_types()
+    await set_commands(bot)
+
+    supervisor = Supervisor(settings.WORKERS)
+    for index in range(settings.WORKERS):
+        supervisor.start_worker(index)
+    logger.info(f"Supervisor started {settings.WORKERS} workers")
+
+    runner = None
+    try:
+        if settings.BOT_MODE == "webhook":
+            secret = settings.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            runner = await start_web_server(_intake_app(supervisor, secret))
+            webhook_url = settings.WEBHOOK_BASE_URL.rstrip("/") + settings.WEBHOOK_PATH
+            await bot.set_webhook(webhook_url, secret_token=secret, allowed_updates=allowed_updates)
+            logger.info(f"Receiving updates at {webhook_url}")
+            while True:
+                await asyncio.sleep(5)
+                supervisor.check_workers()
+        else:
+            await bot.delete_webhook()
+            runner = await start_web_server(_intake_app(supervisor, None))
+            await _poll(supervisor, bot.session.api.api_url(bot.token, "getUpdates"), allowed_updates)
+    finally:
+        supervisor.stop()
+        if runner:
+            await runner.cleanup()
+        await bot.session.close()
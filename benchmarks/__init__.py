@@ -0,0 +1 @@
+# Benchmarks, run as modules from the repo root, e.g. `python -m benchmarks.fsm_storage`
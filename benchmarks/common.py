@@ -0,0 +1,43 @@
+import os
+import statistics
+import tempfile
+import time
+
+def setup_env(db_path: str | None = None) -> str:
+    # Must run before anything from `app` is imported: settings and the engine are module-level
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="bot-bench-"), "bench.db")
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("ADMIN_IDS", "[1]")
+    os.environ.setdefault("PUBLIC_CHANNEL_USERNAMES", "@bench_channel")
+    os.environ.setdefault("PRIVATE_GROUP_ID", "-1001000000000")
+    os.environ.setdefault("PROVIDER_TOKEN", "BENCHMARK")
+    os.environ["USE_POSTGRES"] = os.environ.get("USE_POSTGRES", "False")
+    os.environ["SQLITE_DB"] = f"sqlite+aiosqlite:///{db_path}"
+    return db_path
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(name: str, samples: list[float], elapsed: float | None = None) -> str:
+    # samples in seconds
+    total = elapsed if elapsed is not None else sum(samples)
+    rate = len(samples) / total if total else 0.0
+    return (
+        f"{name:<32} n={len(samples):<7} {rate:>10.0f} ops/s  "
+        f"p50={percentile(samples, 50) * 1e6:>8.1f}us  "
+        f"p99={percentile(samples, 99) * 1e6:>8.1f}us  "
+        f"mean={statistics.fmean(samples) * 1e6 if samples else 0:>8.1f}us"
+    )
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
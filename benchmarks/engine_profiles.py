@@ -0,0 +1,43 @@
+# Compares the engine profiles (DB_PROFILE=default vs tuned) under concurrent handler load.
+# Each profile/concurrency pair runs benchmarks.dispatcher in a fresh process (which creates
+# its own temporary SQLite file), so pragmas and pools never leak between runs.
+#   python -m benchmarks.engine_profiles [--updates 2000] [--concurrency 1,16,64]
+#   USE_POSTGRES=True POSTGRES_HOST=... python -m benchmarks.engine_profiles --postgres
+#       (Postgres runs need an empty database per run; the benchmark seeds fixed user ids)
+import argparse
+import os
+import subprocess
+import sys
+
+PROFILES = ("default", "tuned")
+
+def run(profile: str, concurrency: int, updates: int, postgres: bool, scenarios: list[str]) -> str:
+    env = dict(os.environ, DB_PROFILE=profile)
+    if not postgres:
+        env["USE_POSTGRES"] = "False"
+    cmd = [sys.executable, "-m", "benchmarks.dispatcher", "--updates", str(updates), "--concurrency", str(concurrency)]
+    for scenario in scenarios:
+        cmd += ["--scenario", scenario]
+    result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if result.returncode:
+        return f"failed:\n{result.stderr[-2000:]}"
+    # Drop the header line and the app's log output (stderr)
+    return "\n".join(line for line in result.stdout.splitlines() if not line.startswith("updates="))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", default="1,16,64")
+    parser.add_argument("--postgres", action="store_true", help="use the POSTGRES_* settings from the environment")
+    parser.add_argument("--scenario", action="append", default=None,
+                        help="dispatcher scenarios to run (default: start_new, payments, video_paging)")
+    args = parser.parse_args()
+    scenarios = args.scenario or ["start_new", "payments", "video_paging"]
+
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        for profile in PROFILES:
+            print(f"--- profile={profile} concurrency={concurrency} ({'postgres' if args.postgres else 'sqlite'})")
+            print(run(profile, concurrency, args.updates, args.postgres, scenarios))
+
+if __name__ == "__main__":
+    main()
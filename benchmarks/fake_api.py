@@ -0,0 +1,288 @@
+# Local stand-in for the Telegram Bot API, for end-to-end load tests on one machine.
+#
+#   python -m benchmarks.fake_api serve --port 8081 --latency 0.05 --flood-limit 30 --start-flood 5000
+#       then run the bot against it: TELEGRAM_API_URL=http://127.0.0.1:8081 python -m app.main
+#   python -m benchmarks.fake_api polling --updates 5000
+#   python -m benchmarks.fake_api broadcast --users 5000 --blocked-rate 0.05
+#   python -m benchmarks.fake_api expiry --users 2000
+#
+# Latency, error rate, "bot was blocked" rate and Telegram-style flood control (429 with
+# retry_after once more than --flood-limit sends happen within one second) are configurable.
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from aiohttp import web
+from benchmarks.common import setup_env
+
+setup_env()
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from sqlalchemy import insert, select
+from app.config import settings
+from app.db import init_db, async_session
+from app.db.models import User, Subscription, InviteLink, BroadcastJob
+from benchmarks.fake_telegram import fake_result, message_update
+
+# Methods that count against the per-bot message limit
+SEND_METHODS = {"sendMessage", "copyMessage", "sendPhoto", "sendVideo", "sendInvoice"}
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        blocked_rate: float = 0.0,
+        flood_limit: int | None = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.blocked_rate = blocked_rate
+        self.flood_limit = flood_limit
+
+        self.calls: Counter[str] = Counter()
+        self.responses: Counter[int] = Counter()
+        self.last_call = time.monotonic()  # of anything but getUpdates
+        self._window_start = 0.0
+        self._window_sends = 0
+
+        self.updates: list[dict] = []
+        self.confirmed = 0  # highest update_id the bot has acknowledged via offset
+        self._new_updates = asyncio.Event()
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+    def push_updates(self, updates: list[dict]):
+        self.updates.extend(updates)
+        self._new_updates.set()
+
+    @property
+    def pending_updates(self) -> int:
+        return sum(1 for u in self.updates if u["update_id"] > self.confirmed)
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        # aiogram posts multipart/form-data, with complex values JSON-encoded
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        params.update(request.query)
+        return params
+
+    def _reply(self, status: int, payload: dict) -> web.Response:
+        self.responses[status] += 1
+        return web.json_response(payload, status=status)
+
+    def _error(self, status: int, description: str, **parameters) -> web.Response:
+        payload = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return self._reply(status, payload)
+
+    def _flood_retry_after(self) -> int | None:
+        # Fixed one-second window, which is roughly how Telegram's per-bot limit behaves
+        if self.flood_limit is None:
+            return None
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_sends = 0
+        self._window_sends += 1
+        if self._window_sends > self.flood_limit:
+            return max(1, math.ceil(1 - (now - self._window_start)))
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        self.last_call = time.monotonic()
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method in SEND_METHODS:
+            retry_after = self._flood_retry_after()
+            if retry_after is not None:
+                return self._error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+            if random.random() < self.blocked_rate:
+                return self._error(403, "Forbidden: bot was blocked by the user")
+        if random.random() < self.error_rate:
+            return self._error(500, "Internal Server Error")
+
+        return self._reply(200, {"ok": True, "result": fake_result(method, params)})
+
+    async def _get_updates(self, params: dict) -> web.Response:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.confirmed = max(self.confirmed, offset - 1)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            batch = [u for u in self.updates if u["update_id"] >= offset][:limit]
+            remaining = deadline - time.monotonic()
+            if batch or remaining <= 0:
+                return self._reply(200, {"ok": True, "result": batch})
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def report(self) -> str:
+        calls = ", ".join(f"{name}={count}" for name, count in self.calls.most_common())
+        statuses = ", ".join(f"{status}={count}" for status, count in sorted(self.responses.items()))
+        return f"calls: {calls}\nresponses: {statuses}"
+
+def make_bot(port: int) -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+    return Bot(token=settings.BOT_TOKEN, session=session)
+
+async def wait_idle(api: FakeBotAPI, quiet: float = 1.0):
+    # Done when the bot has acknowledged every update and stopped calling the API
+    while api.pending_updates or time.monotonic() - api.last_call < quiet:
+        await asyncio.sleep(0.1)
+
+async def run_polling(api: FakeBotAPI, args):
+    from app.main import create_dispatcher
+
+    await init_db()
+    bot = make_bot(args.port)
+    dp, _ = create_dispatcher(bot)
+    api.push_updates([message_update(1_000_000 + i, "/start") for i in range(args.updates)])
+
+    started = time.monotonic()
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await wait_idle(api)
+    elapsed = api.last_call - started
+    await dp.stop_polling()
+    await polling
+    print(f"polling: {args.updates} updates in {elapsed:.2f}s ({args.updates / elapsed:.0f} updates/s)")
+
+async def run_broadcast(api: FakeBotAPI, args):
+    from app.services.broadcast import create_job, run_job
+
+    await init_db()
+    async with async_session() as session:
+        await session.execute(insert(User), [
+            {"id": 1_000_000 + i, "username": f"user{i}", "full_name": f"User {i}"} for i in range(args.users)
+        ])
+        await session.commit()
+        job = await create_job(session, from_chat_id=1, message_id=1, progress_chat_id=1, progress_message_id=1)
+
+    bot = make_bot(args.port)
+    started = time.monotonic()
+    await run_job(bot, job.id)
+    elapsed = time.monotonic() - started
+    async with async_session() as session:
+        job = await session.get(BroadcastJob, job.id)
+    print(
+        f"broadcast: {job.total} users in {elapsed:.2f}s ({job.total / elapsed:.1f} msg/s), "
+        f"sent={job.sent} failed={job.failed} blocked={job.blocked}"
+    )
+    await bot.session.close()
+
+async def run_expiry(api: FakeBotAPI, args):
+    from app.services.expiry import run_expiry_sweep
+
+    await init_db()
+    expired_at = datetime.utcnow() - timedelta(minutes=5)
+    user_ids = [1_000_000 + i for i in range(args.users)]
+    async with async_session() as session:
+        await session.execute(insert(User), [
+            {"id": uid, "username": f"user{uid}", "full_name": f"User {uid}", "paid_until": expired_at, "paid_plan_id": 1}
+            for uid in user_ids
+        ])
+        await session.execute(insert(Subscription), [
+            {"user_id": uid, "plan_id": 1, "start_date": expired_at - timedelta(days=30), "end_date": expired_at, "is_active": True}
+            for uid in user_ids
+        ])
+        # Every expired user also holds a join-request link that has to be revoked
+        await session.execute(insert(InviteLink), [
+            {"user_id": uid, "invite_link": f"https://t.me/+bench{uid}", "expire_date": datetime.utcnow() + timedelta(days=1)}
+            for uid in user_ids
+        ])
+        await session.commit()
+
+    bot = make_bot(args.port)
+    stats = await run_expiry_sweep(bot, wait=True)
+    print(
+        f"expiry: expired={stats.expired} kicked={stats.kicked} failures={stats.failures} "
+        f"links_revoked={stats.links_revoked} in {stats.duration:.2f}s"
+    )
+    async with async_session() as session:
+        left = await session.scalar(select(Subscription.id).where(Subscription.is_active == True).limit(1))
+    if left is not None:
+        print("expiry: some subscriptions are still active!")
+    await bot.session.close()
+
+async def serve(api: FakeBotAPI, args):
+    if args.start_flood:
+        api.push_updates([message_update(1_000_000 + i, "/start") for i in range(args.start_flood)])
+    print(f"Fake Bot API on http://127.0.0.1:{args.port} (TELEGRAM_API_URL=http://127.0.0.1:{args.port}); Ctrl+C to stop")
+    try:
+        while True:
+            await asyncio.sleep(5)
+            print(api.report())
+    finally:
+        print(api.report())
+
+async def main(args):
+    api = FakeBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        blocked_rate=args.blocked_rate,
+        flood_limit=args.flood_limit,
+    )
+    runner = await api.start(port=args.port)
+    try:
+        await {"serve": serve, "polling": run_polling, "broadcast": run_broadcast, "expiry": run_expiry}[args.mode](api, args)
+        if args.mode != "serve":
+            print(api.report())
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=("serve", "polling", "broadcast", "expiry"))
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 500")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="share of sends answered with 403 blocked")
+    parser.add_argument("--flood-limit", type=int, default=30, help="sends per second before 429; 0 disables")
+    parser.add_argument("--updates", type=int, default=2000, help="polling: number of /start updates")
+    parser.add_argument("--users", type=int, default=2000, help="broadcast/expiry: number of users")
+    parser.add_argument("--start-flood", type=int, default=0, help="serve: /start updates queued for getUpdates")
+    args = parser.parse_args()
+    args.flood_limit = args.flood_limit or None
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
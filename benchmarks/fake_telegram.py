@@ -0,0 +1,162 @@
+# Canned Bot API results and synthetic updates, shared by the in-memory session
+# (dispatcher benchmark) and the fake HTTP server (end-to-end load tests).
+# Import after benchmarks.common.setup_env(): update builders read app settings.
+import asyncio
+import itertools
+import json
+import time
+from aiogram.client.session.base import BaseSession
+from app.config import settings
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+
+def _chat_id(params: dict) -> int:
+    chat_id = params.get("chat_id")
+    return chat_id if isinstance(chat_id, int) else -1001000000001
+
+def _message(params: dict) -> dict:
+    chat_id = _chat_id(params)
+    return {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        "from": BOT_USER,
+        "text": params.get("text") or "",
+    }
+
+def _chat(params: dict) -> dict:
+    chat_id = params.get("chat_id")
+    chat = {
+        "id": _chat_id(params),
+        "type": "channel",
+        "title": "Bench channel",
+        "accent_color_id": 0,
+        "max_reaction_count": 11,
+    }
+    if isinstance(chat_id, str):
+        chat["username"] = chat_id.lstrip("@")
+    return chat
+
+def _invite_link(params: dict, revoked: bool = False) -> dict:
+    return {
+        "invite_link": params.get("invite_link") or f"https://t.me/+bench{next(_ids)}",
+        "creator": BOT_USER,
+        "creates_join_request": bool(params.get("creates_join_request", True)),
+        "is_primary": False,
+        "is_revoked": revoked,
+        "expire_date": params.get("expire_date"),
+    }
+
+def _chat_member(params: dict) -> dict:
+    return {
+        "status": "member",
+        "user": {"id": params.get("user_id") or 1, "is_bot": False, "first_name": "Bench"},
+    }
+
+RESULTS = {
+    "getMe": lambda p: BOT_USER,
+    "getUpdates": lambda p: [],
+    "sendMessage": _message,
+    "sendPhoto": _message,
+    "sendVideo": _message,
+    "sendInvoice": _message,
+    "editMessageText": _message,
+    "editMessageReplyMarkup": _message,
+    "copyMessage": lambda p: {"message_id": next(_ids)},
+    "getChat": _chat,
+    "getChatMember": _chat_member,
+    "createChatInviteLink": _invite_link,
+    "revokeChatInviteLink": lambda p: _invite_link(p, revoked=True),
+}
+
+def fake_result(api_method: str, params: dict):
+    # Everything not listed (answerCallbackQuery, banChatMember, approveChatJoinRequest, ...) returns True
+    builder = RESULTS.get(api_method)
+    return builder(params) if builder else True
+
+class FakeSession(BaseSession):
+    # Bot session that answers from memory; responses still go through aiogram's parsing
+    def __init__(self, latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = method.model_dump(exclude_none=True)
+        content = json.dumps({"ok": True, "result": fake_result(name, params)}, default=str)
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+# --- Synthetic updates (raw dicts, as Telegram sends them) ---
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+def _message(uid: int, **fields) -> dict:
+    return {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": _user(uid),
+        **fields,
+    }
+
+def message_update(uid: int, text: str) -> dict:
+    fields = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": _message(uid, **fields)}
+
+def callback_update(uid: int, data: str) -> dict:
+    bot_message = _message(uid, text="...")
+    bot_message["from"] = BOT_USER
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(uid),
+            "chat_instance": "bench",
+            "data": data,
+            "message": bot_message,
+        },
+    }
+
+def payment_update(uid: int, plan_id: int = 1, amount: int = 9900000, charge_id: str | None = None) -> dict:
+    charge_id = charge_id or f"tg-{uid}-{next(_update_ids)}"
+    return {"update_id": next(_update_ids), "message": _message(uid, successful_payment={
+        "currency": settings.CURRENCY,
+        "total_amount": amount,
+        "invoice_payload": f"plan_id:{plan_id}",
+        "telegram_payment_charge_id": charge_id,
+        "provider_payment_charge_id": f"provider-{charge_id}",
+    })}
+
+def pre_checkout_update(uid: int, plan_id: int = 1, amount: int = 9900000, payload: str | None = None) -> dict:
+    return {"update_id": next(_update_ids), "pre_checkout_query": {
+        "id": str(next(_update_ids)),
+        "from": _user(uid),
+        "currency": settings.CURRENCY,
+        "total_amount": amount,
+        "invoice_payload": payload or f"plan_id:{plan_id}",
+    }}
+
+def join_request_update(uid: int) -> dict:
+    return {"update_id": next(_update_ids), "chat_join_request": {
+        "chat": {"id": settings.PRIVATE_GROUP_ID, "type": "supergroup", "title": "Bench group"},
+        "from": _user(uid),
+        "user_chat_id": uid,
+        "date": int(time.time()),
+    }}
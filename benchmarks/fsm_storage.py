@@ -0,0 +1,66 @@
+# Compares the FSM read path of SQLAlchemyStorage with MemoryStorage.
+#   python -m benchmarks.fsm_storage [iterations]
+import asyncio
+import sys
+import time
+from benchmarks.common import setup_env, summarize
+
+setup_env()
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from app.bot.handlers.admin import AddPlanStates
+from app.bot.storage import SQLAlchemyStorage
+from app.db import init_db, async_session
+
+async def read_loop(storage, key: StorageKey, iterations: int) -> list[float]:
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await storage.get_state(key)
+        await storage.get_data(key)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+async def users_loop(storage, users: int) -> list[float]:
+    # What the dispatcher does per update: load the sender's state, nearly always empty
+    samples = []
+    for uid in range(1_000_000, 1_000_000 + users):
+        started = time.perf_counter()
+        await storage.get_state(StorageKey(bot_id=1, chat_id=uid, user_id=uid))
+        samples.append(time.perf_counter() - started)
+    return samples
+
+async def main(iterations: int):
+    await init_db()
+    key = StorageKey(bot_id=1, chat_id=42, user_id=42)
+    data = {"name": "VIP Obuna", "days": 30}
+
+    memory = MemoryStorage()
+    await memory.set_state(key, AddPlanStates.waiting_for_price)
+    await memory.set_data(key, data)
+
+    stored = SQLAlchemyStorage(async_session)
+    await stored.set_state(key, AddPlanStates.waiting_for_price)
+    await stored.set_data(key, data)
+
+    write_samples = []
+    for i in range(min(iterations, 2000)):
+        started = time.perf_counter()
+        await stored.set_data(key, {**data, "i": i})
+        write_samples.append(time.perf_counter() - started)
+
+    print(summarize("MemoryStorage read", await read_loop(memory, key, iterations)))
+    print(summarize("SQLAlchemyStorage read", await read_loop(stored, key, min(iterations, 2000))))
+    print(summarize("SQLAlchemyStorage write", write_samples))
+
+    # Many senders without state: first update of each, then the steady state
+    users = min(iterations, 5000)
+    plain = SQLAlchemyStorage(async_session)
+    admins_only = SQLAlchemyStorage(async_session, state_holders=[1])
+    print(summarize("MemoryStorage users", await users_loop(memory, users)))
+    print(summarize("SQLAlchemyStorage users", await users_loop(plain, users)))
+    print(summarize("SQLAlchemyStorage users (holders)", await users_loop(admins_only, users)))
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,68 @@
+# Per-message cost of building reply markups: the old per-call builders vs the cached ones.
+#   python -m benchmarks.keyboards [iterations]
+# CPU is timed with timeit-style loops; memory is the tracemalloc peak per message.
+import asyncio
+import sys
+import time
+import tracemalloc
+from benchmarks.common import setup_env
+
+setup_env()
+
+from sqlalchemy import select
+from app.bot import keyboards
+from app.db import init_db, async_session
+from app.db.models import Plan
+from app.services.catalog import plan_catalog
+
+async def measure(fn, iterations: int) -> tuple[float, float]:
+    # -> (microseconds per call, peak KiB allocated per call)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await fn()
+    cpu = (time.perf_counter() - started) / iterations * 1e6
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(iterations, 500)):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await fn()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - base)
+    tracemalloc.stop()
+    return cpu, sum(peaks) / len(peaks) / 1024
+
+def sync(builder):
+    async def call():
+        builder()
+    return call
+
+async def plans_before():
+    # What start_button_handler used to do on every press
+    async with async_session() as session:
+        plans = (await session.scalars(select(Plan).where(Plan.is_active == True))).all()
+    keyboards.get_plans_keyboard(list(plans))
+
+async def plans_after():
+    await plan_catalog.ensure_fresh()
+    return plan_catalog.keyboard
+
+async def main(iterations: int):
+    await init_db()
+
+    scenarios = [
+        ("welcome keyboard", sync(keyboards.get_welcome_keyboard.__wrapped__), sync(keyboards.get_welcome_keyboard)),
+        ("main menu", sync(keyboards.get_main_menu.__wrapped__), sync(keyboards.get_main_menu)),
+        ("renewal keyboard", sync(keyboards.get_subscription_renewal_keyboard.__wrapped__), sync(keyboards.get_subscription_renewal_keyboard)),
+        ("plans (query + build)", plans_before, plans_after),
+    ]
+    print(f"{'scenario':<24} {'before us':>10} {'after us':>10} {'before KiB':>11} {'after KiB':>10}")
+    for name, before, after in scenarios:
+        n = iterations if "plans" not in name else min(iterations, 2000)
+        cpu_before, mem_before = await measure(before, n)
+        cpu_after, mem_after = await measure(after, n)
+        print(f"{name:<24} {cpu_before:>10.1f} {cpu_after:>10.2f} {mem_before:>11.2f} {mem_after:>10.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,18 @@
+import asyncio
+import sys
+import os
+
+# Set Python path to include current directory
+sys.path.append(os.getcwd())
+
+from app.db import async_session
+from app.services.stats import rebuild_stats, get_stats
+
+async def main():
+    async with async_session() as session:
+        await rebuild_stats(session)
+        stats = await get_stats(session)
+    print(f"Users: {stats.users}, Active subs: {stats.active_subs}, Expired: {stats.expired_subs}, Revenue: {stats.revenue / 100:,.0f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
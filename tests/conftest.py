@@ -0,0 +1,33 @@
+# Tests run against a throwaway SQLite database. Settings and the engine are module-level,
+# so the environment is set up before anything from `app` is imported.
+import asyncio
+import os
+import tempfile
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_IDS", "[1]")
+os.environ.setdefault("PUBLIC_CHANNEL_USERNAMES", "@test_channel")
+os.environ.setdefault("PRIVATE_GROUP_ID", "-1001000000000")
+os.environ.setdefault("PROVIDER_TOKEN", "TEST")
+os.environ["USE_POSTGRES"] = "False"
+os.environ["SQLITE_DB"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='bot-test-'), 'test.db')}"
+
+from app.db import engine, init_db
+
+def run_async(coro):
+    # Each test gets its own event loop; pooled connections must not outlive it
+    async def wrapper():
+        try:
+            return await coro
+        finally:
+            await engine.dispose()
+    return asyncio.run(wrapper())
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    run_async(init_db())
+
+@pytest.fixture
+def run():
+    return run_async
@@ -0,0 +1,51 @@
+import asyncio
+import time
+from sqlalchemy import insert
+from app.db import async_session
+from app.db.models import BroadcastJob, User
+from app.services import broadcast
+
+class SlowBot:
+    id = 123456
+
+    def __init__(self):
+        self.sent = 0
+
+    async def copy_message(self, **params):
+        await asyncio.sleep(0.01)
+        self.sent += 1
+
+    async def edit_message_text(self, *args, **params):
+        pass
+
+def test_cancel_from_another_worker(run, monkeypatch):
+    # The cancel button is handled by a process that doesn't run the job: only the DB flag connects them
+    monkeypatch.setattr(broadcast, "PROGRESS_INTERVAL", 0.2)
+    bot = SlowBot()
+
+    async def scenario():
+        async with async_session() as session:
+            await session.execute(insert(User), [{"id": 7_300_000 + i, "full_name": "Test"} for i in range(300)])
+            await session.commit()
+            job = await broadcast.create_job(session, 1, 1, 1, 1)
+        runner = asyncio.create_task(broadcast.run_job(bot, job.id))
+        await asyncio.sleep(0.5)
+
+        async with async_session() as session:
+            await broadcast.cancel_job(session, job.id)
+            await session.commit()
+        cancelled_at = time.monotonic()
+        await asyncio.wait_for(runner, 10)
+        took = time.monotonic() - cancelled_at
+
+        async with async_session() as session:
+            return await session.get(BroadcastJob, job.id), took
+
+    job, took = run(scenario())
+    assert job.status == "cancelled"
+    assert took < 2
+    assert bot.sent < 300
+
+def test_other_workers_leave_jobs_to_worker_zero(monkeypatch):
+    monkeypatch.setattr(broadcast, "runs_jobs", False)
+    assert broadcast.start_job(SlowBot(), 1) is None
@@ -0,0 +1,26 @@
+from aiogram.fsm.storage.base import StorageKey
+from app.bot.storage import SQLAlchemyStorage
+from app.db import async_session
+
+ADMIN = 1
+
+def test_state_written_on_one_replica_is_read_on_another(run):
+    # No sticky routing between replicas: every read must see the latest write
+    key = StorageKey(bot_id=1, chat_id=ADMIN, user_id=ADMIN)
+
+    async def scenario():
+        a = SQLAlchemyStorage(async_session, state_holders=[ADMIN])
+        b = SQLAlchemyStorage(async_session, state_holders=[ADMIN])
+        seen = [await b.get_state(key)]
+        await a.set_state(key, "AddPlanStates:waiting_for_price")
+        await a.set_data(key, {"name": "VIP"})
+        seen.append((await b.get_state(key), await b.get_data(key)))
+        await a.set_state(key, None)
+        await a.set_data(key, {})
+        seen.append((await b.get_state(key), await b.get_data(key)))
+        return seen
+
+    before, during, after = run(scenario())
+    assert before is None
+    assert during == ("AddPlanStates:waiting_for_price", {"name": "VIP"})
+    assert after == (None, {})
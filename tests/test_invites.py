@@ -0,0 +1,58 @@
+import time
+from datetime import datetime
+from aiogram.types import ChatInviteLink, User
+from sqlalchemy import delete
+from app.db import async_session
+from app.db.models import InviteLink
+from app.services.invites import get_invite_link, INVITE_LINK_TTL
+
+class RecordingBot:
+    id = 123456
+
+    def __init__(self):
+        self.calls = []
+
+    async def create_chat_invite_link(self, **params):
+        self.calls.append(params)
+        return ChatInviteLink(
+            invite_link=f"https://t.me/+test{len(self.calls)}",
+            creator=User(id=self.id, is_bot=True, first_name="Test"),
+            creates_join_request=True,
+            is_primary=False,
+            is_revoked=False,
+        )
+
+def test_invite_link_expiry_is_sent_as_utc_timestamp(run):
+    bot = RecordingBot()
+
+    async def scenario():
+        async with async_session() as session:
+            link = await get_invite_link(session, bot, 7_000_001)
+            row = await session.get(InviteLink, 7_000_001)
+        return link, row
+
+    link, row = run(scenario())
+    assert link == row.invite_link
+    sent = bot.calls[0]["expire_date"]
+    # Independent of the host's timezone: an absolute timestamp one TTL from now
+    assert isinstance(sent, int)
+    assert abs(sent - (time.time() + INVITE_LINK_TTL.total_seconds())) < 60
+    assert abs((row.expire_date - datetime.utcnow()) - INVITE_LINK_TTL).total_seconds() < 60
+
+def test_revoked_link_is_not_handed_out_again(run):
+    # The sweep revokes in worker 0, the user's next tap may land on any other worker
+    bot = RecordingBot()
+
+    async def scenario():
+        async with async_session() as session:
+            first = await get_invite_link(session, bot, 7_000_002)
+        # What revoke_invite_links does in the other process
+        async with async_session() as session:
+            await session.execute(delete(InviteLink).where(InviteLink.user_id == 7_000_002))
+            await session.commit()
+        async with async_session() as session:
+            second = await get_invite_link(session, bot, 7_000_002)
+        return first, second
+
+    first, second = run(scenario())
+    assert second != first
@@ -0,0 +1,137 @@
+import asyncio
+from datetime import timedelta
+from sqlalchemy import func, select
+from app.db import async_session
+from app.db.utils import serialize_writes
+from app.db.models import Payment, StatsRollup, Subscription, User
+from app.services.catalog import CatalogPlan, PlanCatalog
+from app.services.stats import TOTAL
+from app.services.subscriptions import _entitlements, get_entitlement, invalidate_entitlement, record_payment
+
+MONTH = CatalogPlan(id=1, name="1 Oylik", duration_days=30, price=9900000, is_active=True)
+LIFETIME = CatalogPlan(id=3, name="Lifetime", duration_days=None, price=59900000, is_active=True)
+
+async def pay(user_id: int, charge_id: str, plan: CatalogPlan = MONTH):
+    async with async_session() as session:
+        result = await record_payment(
+            session, user_id, plan, amount=plan.price, currency="UZS", provider="TEST", charge_id=charge_id,
+            username=f"user{user_id}", full_name="Test",
+        )
+        await session.commit()
+        return result
+
+async def totals() -> tuple[int, int, int]:
+    async with async_session() as session:
+        row = await session.get(StatsRollup, TOTAL)
+        return (row.signups, row.new_subs, row.revenue) if row else (0, 0, 0)
+
+async def count(model, user_id: int) -> int:
+    async with async_session() as session:
+        return await session.scalar(select(func.count()).select_from(model).where(model.user_id == user_id))
+
+def test_concurrent_duplicate_delivery(run):
+    # The same successful_payment delivered twice at once, for a user who never sent /start
+    user_id = 7_400_001
+
+    async def scenario():
+        before = await totals()
+        results = await asyncio.gather(pay(user_id, "dup-charge"), pay(user_id, "dup-charge"))
+        after = await totals()
+        return results, before, after, await count(Payment, user_id), await count(Subscription, user_id)
+
+    results, before, after, payments, subscriptions = run(scenario())
+    assert sum(result is not None for result in results) == 1
+    assert (payments, subscriptions) == (1, 1)
+    signups, new_subs, revenue = (a - b for a, b in zip(after, before))
+    assert (signups, new_subs, revenue) == (1, 1, MONTH.price)
+
+def test_second_payment_extends_current_subscription(run):
+    user_id = 7_400_002
+
+    async def scenario():
+        first = await pay(user_id, "extend-1")
+        before = await totals()
+        second = await pay(user_id, "extend-2")
+        after = await totals()
+        async with async_session() as session:
+            user = await session.get(User, user_id)
+        return first, second, before, after, user, await count(Subscription, user_id)
+
+    first, second, before, after, user, subscriptions = run(scenario())
+    assert not first.extended and second.extended
+    assert second.subscription_id == first.subscription_id
+    assert subscriptions == 1
+    assert abs((second.end_date - first.end_date) - timedelta(days=30)) < timedelta(seconds=5)
+    assert user.paid_until == second.end_date
+    signups, new_subs, revenue = (a - b for a, b in zip(after, before))
+    assert (signups, new_subs, revenue) == (0, 0, MONTH.price)
+
+def test_dated_plan_leaves_lifetime_subscription_alone(run):
+    user_id = 7_400_004
+
+    async def scenario():
+        lifetime = await pay(user_id, "lifetime-1", LIFETIME)
+        before = await totals()
+        month = await pay(user_id, "lifetime-2")
+        after = await totals()
+        async with async_session() as session:
+            user = await session.get(User, user_id)
+            subscription = await session.get(Subscription, lifetime.subscription_id)
+        return lifetime, month, before, after, user, subscription, await count(Payment, user_id)
+
+    lifetime, month, before, after, user, subscription, payments = run(scenario())
+    assert month.subscription_id == lifetime.subscription_id and month.end_date is None
+    assert (subscription.plan_id, subscription.end_date) == (LIFETIME.id, None)
+    assert user.is_lifetime and user.paid_plan_id == LIFETIME.id and user.paid_until is None
+    assert payments == 2
+    signups, new_subs, revenue = (a - b for a, b in zip(after, before))
+    assert (signups, new_subs, revenue) == (0, 0, MONTH.price)
+
+def test_sqlite_write_queue_is_released_when_the_transaction_ends(run):
+    async def scenario():
+        async with async_session() as session:
+            await serialize_writes(session)
+            await session.rollback()
+        async with async_session() as session:
+            # Closed without commit or rollback
+            await serialize_writes(session)
+        async with async_session() as session:
+            await asyncio.wait_for(serialize_writes(session), timeout=1)
+            await pay(7_400_005, "queue-1")
+            await session.commit()
+
+    run(scenario())
+
+def test_aged_out_plan_catalog_is_served_until_the_swap(run):
+    # pre_checkout readers get the old snapshot while it is rebuilt in the background
+    async def scenario():
+        catalog = PlanCatalog()
+        await catalog.ensure_fresh()
+        old, version = catalog.active, catalog.version
+        catalog.max_age = 0
+        await catalog.ensure_fresh(allow_stale=True)
+        await asyncio.sleep(0)
+        # The rebuild is now waiting on its query; readers must not wait with it
+        await asyncio.wait_for(catalog.ensure_fresh(allow_stale=True), timeout=0.001)
+        served = catalog.active
+        await catalog._refresh
+        return old, version, served, catalog.active, catalog.version, catalog.check_invoice("plan_id:1", MONTH.price, "UZS", "UZS")
+
+    old, version, served, rebuilt, version_after, reason = run(scenario())
+    assert served is old
+    assert rebuilt is not old and rebuilt == old
+    assert version_after == version
+    assert reason is None
+
+def test_entitlement_read_racing_a_payment_is_not_cached(run):
+    # The reader loads the users row, then the payment commits and invalidates, then the
+    # reader would store "not subscribed" for the user who has just paid
+    user_id = 7_400_003
+
+    class RacingSession:
+        async def get(self, model, key):
+            invalidate_entitlement(key)
+            return None
+
+    assert run(get_entitlement(RacingSession(), user_id)) is None
+    assert user_id not in _entitlements
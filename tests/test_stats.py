@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from app.db import async_session
+from app.db.models import StatsRollup, Subscription, User
+from app.services.stats import rebuild_stats
+from app.services.subscriptions import expire_subscriptions_batch
+
+async def expirations_by_bucket(session) -> dict[str, int]:
+    rows = (await session.execute(select(StatsRollup.bucket, StatsRollup.expirations))).all()
+    return {bucket: expirations for bucket, expirations in rows if expirations}
+
+def test_late_sweep_matches_rebuild(run):
+    # Subscriptions that ended days ago, expired by a sweep that runs only now
+    async def scenario():
+        now = datetime.utcnow()
+        ended = [now - timedelta(days=3), now - timedelta(days=2), now - timedelta(days=2)]
+        async with async_session() as session:
+            await rebuild_stats(session)
+            user_ids = [7_100_000 + i for i in range(len(ended))]
+            await session.execute(insert(User), [{"id": uid, "full_name": "Test"} for uid in user_ids])
+            await session.execute(insert(Subscription), [
+                {"user_id": uid, "plan_id": 1, "start_date": end - timedelta(days=30), "end_date": end, "is_active": True}
+                for uid, end in zip(user_ids, ended)
+            ])
+            await session.commit()
+
+            while await expire_subscriptions_batch(session):
+                pass
+            live = await expirations_by_bucket(session)
+            await rebuild_stats(session)
+            rebuilt = await expirations_by_bucket(session)
+        return ended, live, rebuilt
+
+    ended, live, rebuilt = run(scenario())
+    assert live == rebuilt
+    assert live[ended[0].date().isoformat()] >= 1
+    assert live[ended[1].date().isoformat()] >= 2
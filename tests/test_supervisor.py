@@ -0,0 +1,50 @@
+import asyncio
+from aiohttp import web
+from app.supervisor import _poll
+
+class RecordingSupervisor:
+    def __init__(self):
+        self.dispatched = asyncio.Event()
+        self.updates = []
+
+    def check_workers(self):
+        pass
+
+    async def dispatch(self, updates):
+        self.updates.extend(updates)
+        self.dispatched.set()
+
+def test_poll_survives_broken_responses(run):
+    # A proxy error page, then a dropped connection, then a normal answer
+    update = {"update_id": 1, "message": {"from": {"id": 42}, "chat": {"id": 42}}}
+    responses = iter(["html", "disconnect", "ok"])
+
+    async def get_updates(request: web.Request):
+        kind = next(responses, "empty")
+        if kind == "html":
+            return web.Response(status=502, text="<html>Bad Gateway</html>", content_type="text/html")
+        if kind == "disconnect":
+            request.transport.close()
+            return web.Response()
+        return web.json_response({"ok": True, "result": [update] if kind == "ok" else []})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/getUpdates", get_updates)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        supervisor = RecordingSupervisor()
+        poller = asyncio.create_task(_poll(supervisor, f"http://127.0.0.1:{port}/getUpdates", []))
+        try:
+            await asyncio.wait_for(supervisor.dispatched.wait(), 10)
+        finally:
+            poller.cancel()
+            await runner.cleanup()
+        return poller, supervisor.updates
+
+    poller, updates = run(scenario())
+    assert updates == [update]
+    assert poller.cancelled()
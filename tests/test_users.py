@@ -0,0 +1,68 @@
+from datetime import datetime
+from sqlalchemy import insert, select
+from app.db import async_session
+from app.db.models import User
+from app.services.users import ProfileBuffer, register_user
+
+def test_profile_flush_skips_unknown_ids(run):
+    # Senders who never sent /start have no users row; they must not fail the batch
+    async def scenario():
+        async with async_session() as session:
+            await session.execute(insert(User), [
+                {"id": 7_200_001, "username": "old1", "full_name": "Old 1"},
+                {"id": 7_200_002, "username": "old2", "full_name": "Old 2"},
+            ])
+            await session.commit()
+
+        buffer = ProfileBuffer()
+        buffer.observe(7_200_001, "new1", "New 1")
+        buffer.observe(7_299_999, "ghost", "Never started")
+        buffer.observe(7_200_002, "new2", "New 2")
+        flushed = await buffer.flush()
+
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(User.id, User.username).where(User.id.between(7_200_000, 7_299_999)).order_by(User.id)
+            )).all()
+        return flushed, buffer._pending, rows
+
+    flushed, pending, rows = run(scenario())
+    assert flushed == 3
+    assert pending == {}
+    assert [tuple(row) for row in rows] == [(7_200_001, "new1"), (7_200_002, "new2")]
+
+def test_profile_flush_keeps_broadcast_block(run):
+    async def scenario():
+        async with async_session() as session:
+            await session.execute(insert(User), [
+                {"id": 7_200_010, "username": "old", "full_name": "Old", "blocked_at": datetime.utcnow()},
+            ])
+            await session.commit()
+        buffer = ProfileBuffer()
+        buffer.observe(7_200_010, "renamed", "Renamed")
+        await buffer.flush()
+        async with async_session() as session:
+            return await session.get(User, 7_200_010)
+
+    user = run(scenario())
+    assert user.username == "renamed"
+    assert user.blocked_at is not None
+
+def test_start_registers_once_and_unblocks(run):
+    async def scenario():
+        async with async_session() as session:
+            first = await register_user(session, 7_200_020, "u", "U")
+            again = await register_user(session, 7_200_020, "u", "U")
+            await session.commit()
+            user = await session.get(User, 7_200_020)
+            user.blocked_at = datetime.utcnow()
+            await session.commit()
+            after_block = await register_user(session, 7_200_020, "u", "U")
+            await session.commit()
+            session.expire_all()
+            user = await session.get(User, 7_200_020)
+        return first, again, after_block, user.blocked_at
+
+    first, again, after_block, blocked_at = run(scenario())
+    assert (first, again, after_block) == (True, False, False)
+    assert blocked_at is None